@@ -152,7 +152,33 @@ ifdef EXTRA_SUBDIRS
   DEPS_EXTRA_PARAM += --extrasubdirs '$(EXTRA_SUBDIRS)'
 endif
 
-MAKEDEPEND_CMD := $(BUILD_SCRIPTS)/build_dependency_files.py $(DEPS_EXTRA_PARAM) --ignorefile $(IGNORE_FILE) $(IGNORE_PARAM) $(SRC_BASE_DIR) $(DEP_DIR)
+## Set `WHOLE_DESIGN=1` to update the .d files of every dependency each time dependencies are analyzed, instead of one make restart per out of date .d file. Files are parsed with `CPUS` processes unless `SLOW` is set
+# WHOLE_DESIGN: set in upper Makefile or environment
+ifdef WHOLE_DESIGN
+  DEPS_EXTRA_PARAM += --whole-design
+  # A whole design run parses many files in one rule, so give it a pool of
+  # parse processes. Otherwise each .d rule parses little, and make already
+  # runs them in parallel, so a pool in every rule would only add processes.
+  ifndef SLOW
+    DEPS_EXTRA_PARAM += --jobs $(CPUS)
+  endif
+endif
+
+DEPS_TRACE_DIR := $(BLOG_DIR)/deps_trace
+## Set `DEPS_TRACE=1` to trace where dependency analysis spends its time. See the `deps_trace` target.
+# DEPS_TRACE: set in upper Makefile or environment
+ifdef DEPS_TRACE
+  DEPS_EXTRA_PARAM += --tracedir $(DEPS_TRACE_DIR)
+endif
+
+# The source index is saved between runs so unchanged directories are not
+# listed again each time a .d file is created
+SOURCE_INDEX := $(BLD_DIR)/source_index.json
+# Parse results are saved by file contents hash, so unchanged files aren't
+# parsed again and .d files are only rewritten when the dependencies change
+PARSE_CACHE := $(BLD_DIR)/parse_cache.json
+
+MAKEDEPEND_CMD := $(BUILD_SCRIPTS)/build_dependency_files.py $(DEPS_EXTRA_PARAM) --stampdir $(DONE_DIR) --indexfile $(SOURCE_INDEX) --parsecache $(PARSE_CACHE) --ignorefile $(IGNORE_FILE) $(IGNORE_PARAM) $(SRC_BASE_DIR) $(DEP_DIR)
 
 
 ##################### Cleaning targets ##############################
@@ -195,6 +221,11 @@ print-%:
 print-Makefiles:
 	@echo $(MAKEFILE_LIST)
 
+.PHONY: deps_trace
+## target to merge the traces of `DEPS_TRACE=1` runs into `$(BLOG_DIR)/deps_trace.json` and show the slowest modules and the critical path of dependency analysis
+deps_trace:
+	@$(BUILD_SCRIPTS)/dep_trace.py $(DEPS_TRACE_DIR) -o $(BLOG_DIR)/deps_trace.json
+
 # Help is a line starting with '##' followed by help text
 # The next line is the subject of the help followed by ':'
 HELP_GREP := grep --no-group-separator -A1 -hE '^\#\# ' $(MAKEFILE_LIST)
@@ -3,16 +3,12 @@ import os
 import sys
 import yaml
 import argparse
-from find_dependencies import find_deps
-
-filelist_git_cmd = (
-    "cd {srcbase} && git ls-files --cached --modified --others "
-    "--full-name --exclude-standard {srcbase} | grep -i "
-    "-e '\\.sv$' -e '\\.svh$' -e '\\.v$' -e '\\.vh$' -e {ignorefile}")
-
-# Git ls-files is faster, but if not using git, this command works
-filelist_find_cmd = ("find {srcbase} | grep -i -e '\\.sv$' -e '\\.svh$' "
-                     "-e '\\.v$' -e '\\.vh$' -e {ignorefile}")
+from concurrent.futures import ProcessPoolExecutor
+import dep_trace
+from find_dependencies import (find_deps, parse_file_traced, cached_deps,
+                               dep_list, source_bytes, load_parse_cache,
+                               save_parse_cache)
+from source_index import srcdir_files, build_name_index, is_git_base
 
 
 svh_hdr = """ifeq (,$(findstring +{dirpath}",$(VLOG_INCLUDES)))
@@ -23,6 +19,7 @@ endif
 o_string = "$(DEP_DIR)/{name}.{prefix}.o: {path}"
 o_dep_string = "\\\n\t$(DEP_DIR)/{dep}.{prefix}.o"
 d_string = "$(DEP_DIR)/{name}.{prefix}.d: {path}"
+stamp_string = "{stampdir}/{name}.{prefix}.deps.done: {path}"
 incl_string = """ifeq (,$(filter $(DEP_DIR)/{dep}.{prefix}.d,$(MAKEFILE_LIST)))
 -include $(DEP_DIR)/{dep}.{prefix}.d
 endif
@@ -30,7 +27,11 @@ endif
 dep_set_string = "{name}_DEPS := $(call uniq,"
 incl_set_string = "{name}_INCLUDE := $(call uniq,"
 
-seen_deps = []
+seen_deps = set()
+# Parse results of file contents, see find_dependencies.find_deps
+parse_cache = {}
+# Levels with fewer files to parse than this aren't worth sending to the pool
+min_pool_files = 16
 
 
 def add_subs_module(srcbase, module, filepath, subs_dict):
@@ -78,30 +79,137 @@ def parse_subs_yaml(subsfilelist, srcbase, verbose=True):
     return subs_dict
 
 
-def find_module(name, filelist, subs_dict):
+def find_module(name, name_index, subs_dict):
+    dep_trace.count('module lookups')
     if name in subs_dict:
         return subs_dict[name]
-    # Make module names unique file basenames, prefix path sep and add period
-    fname = os.path.sep + name
-    if "." not in name:
-        fname = fname + "."
-    matched_paths = [path for path in filelist if fname in path]
+    # Module names are unique file basenames, see build_name_index
+    matched_paths = name_index.get(name, [])
     if len(matched_paths) > 1:
         matches = " : ".join(matched_paths)
         print(f"Warning: found multiple file entries for {name}: {matches}")
         print()
     if len(matched_paths) == 0:
         # No match
+        dep_trace.count('module lookups not found')
         return None
     return matched_paths[0]
 
 
-def write_depfile(name, filelist, subs_dict, args):
-    global seen_deps
+def write_text(fname, text):
+    ''' Write text to fname, returning False if fname already matched
+        Make restarts when an included .d file changes, so leave the file
+        alone if an edit (like a comment) didn't change the dependencies.
+        The file is then older than its source, see touch_stamp.'''
+    if os.path.exists(fname) and open(fname, 'r').read() == text:
+        return False
+    # Other processes may be reading or writing the same file, so replace it
+    tmpfile = f"{fname}.{os.getpid()}.tmp"
+    open(tmpfile, 'w').write(text)
+    os.replace(tmpfile, fname)
+    return True
+
+
+def has_deps(path):
+    return ".sv" in path or ".v" in path
+
+
+def parse_worker(path):
+    ''' parse_file_traced against this process's parse_cache
+        Forked pool workers start with a copy of the cache the parent loaded,
+        so they only read and hash files the cache already has.'''
+    return parse_file_traced(path, parse_cache)
+
+
+def parse_level(level, name_index, subs_dict, pool, keys):
+    ''' Return {name: deps} for a list of names, adding new parse results
+        to parse_cache and the content hash of each name to keys. Files are
+        read, hashed and parsed by pool when there are enough of them.'''
+    paths = {}
+    for name in level:
+        path = find_module(name, name_index, subs_dict)
+        if path is not None and has_deps(path):
+            paths[name] = path
+    # Several names can share one file, only parse it once
+    files = list(dict.fromkeys(paths.values()))
+    if len(files) >= min_pool_files:
+        # map returns results in order, so the cache order is deterministic
+        results = pool.map(parse_worker, files, chunksize=4)
+    else:
+        results = map(parse_worker, files)
+    file_keys = {}
+    parsed_count = 0
+    for path, (key, parsed, timing) in zip(files, results):
+        file_keys[path] = key
+        if parsed is None or key in parse_cache:
+            continue
+        parse_cache[key] = parsed
+        parsed_count += 1
+        start, duration, pid = timing
+        dep_trace.add('parse', 'parse', start, duration, tid=pid, path=path,
+                      bytes=os.path.getsize(path))
+    dep_trace.count('prefetch cache hits', len(files) - parsed_count)
+    dep_trace.count('prefetch parsed', parsed_count)
+    level_deps = {}
+    for name, path in paths.items():
+        keys[name] = file_keys[path]
+        level_deps[name] = dep_list(name, parse_cache[keys[name]])
+    return level_deps
+
+
+def prefetch_deps(name, name_index, subs_dict, args):
+    ''' Parse all files write_depfile will need using args.jobs processes
+        The tree is walked a level at a time, and each level is parsed in
+        parallel. Returns {name: content hash} so write_depfile finds every
+        result in parse_cache without reading the files again, and writes
+        the same .d files as a serial run.'''
+    prefix = args.outprefixlist.split(',')[-1]
+    keys = {}
+    seen = {name}
+    level = [name]
+    with ProcessPoolExecutor(args.jobs) as pool:
+        while level:
+            next_level = []
+            with dep_trace.span('prefetch level', 'step', names=len(level)):
+                level_deps = parse_level(level, name_index, subs_dict, pool,
+                                         keys)
+            for deps in level_deps.values():
+                for dep in deps:
+                    if dep in seen:
+                        continue
+                    seen.add(dep)
+                    fname = os.path.join(args.outdir, f"{dep}.{prefix}.d")
+                    # Same recursion limit as write_depfile
+                    if not args.whole_design and os.path.exists(fname):
+                        continue
+                    next_level.append(dep)
+            level = next_level
+    return keys
+
+
+def touch_stamp(name, prefix, args):
+    ''' Mark the dependencies of name as checked
+        With --stampdir the .d file makes this stamp depend on the source
+        instead of the .d file itself, so a .d file kept by write_text
+        isn't checked again on every make run.'''
+    if not args.stampdir:
+        return
+    os.makedirs(args.stampdir, exist_ok=True)
+    stamp = os.path.join(args.stampdir, f"{name}.{prefix}.deps.done")
+    open(stamp, 'a').close()
+    os.utime(stamp)
+
+
+def write_depfile(name, name_index, subs_dict, args, keys=None, active=()):
+    ''' Write .d files for name, recursing through its dependencies
+        keys = {name: content hash} of files prefetch_deps already parsed
+        active = tuple of names on the current recursion path, a dependency
+                 on one of these is a loop and is dropped'''
     print(name)
-    path = find_module(name, filelist, subs_dict)
+    path = find_module(name, name_index, subs_dict)
     if path is None:
         return
+    start = dep_trace.now()
     prefixes = args.outprefixlist.split(',')
     ostrings = {}
     dstrings = {}
@@ -109,7 +217,11 @@ def write_depfile(name, filelist, subs_dict, args):
 
     for prefix in prefixes:
         ostrings[prefix] = o_string.format(**locals())
-        dstrings[prefix] = d_string.format(**locals())
+        if args.stampdir:
+            stampdir = args.stampdir
+            dstrings[prefix] = stamp_string.format(**locals())
+        else:
+            dstrings[prefix] = d_string.format(**locals())
         istrings[prefix] = ""
     if (name.endswith('.svh') or name.endswith('.vh')):
         dirpath = os.path.dirname(path)
@@ -117,21 +229,25 @@ def write_depfile(name, filelist, subs_dict, args):
             ostrings[prefix] = svh_hdr.format(**locals()) + ostrings[prefix]
     incl_var_string = incl_set_string.format(**locals())
     dep_var_string = dep_set_string.format(**locals())
-    if ".sv" not in path and ".v" not in path:
+    if not has_deps(path):
         deps = []
+    elif keys and keys.get(name) in parse_cache:
+        deps = cached_deps(name, keys[name], parse_cache)
     else:
-        text = open(path, 'r').read()
-        deps = find_deps(path, name, text, args)
+        text = source_bytes(path)
+        deps = find_deps(path, name, text, args, parse_cache)
     print(f"Processing dependencies for {name}: {deps}")
 
+    active = active + (name,)
     for dep in deps:
-        # TODO: find better way to remove dependency loops
-        if (name == "lib_pkt_if_macros.svh"):
-            continue
-        dep_path = find_module(dep, filelist, subs_dict)
+        dep_path = find_module(dep, name_index, subs_dict)
         # Unknown module found
         if dep_path is None:
             continue
+        if dep in active:
+            loop = " -> ".join(active + (dep,))
+            print(f"Warning: dropping dependency loop {loop}")
+            continue
         for prefix in prefixes:
             ostrings[prefix] += o_dep_string.format(**locals())
             istrings[prefix] += incl_string.format(**locals())
@@ -146,52 +262,51 @@ def write_depfile(name, filelist, subs_dict, args):
         if (dep in seen_deps):
             print(f"End recursion for {dep}, already seen")
             continue
-        if (os.path.exists(fname)):
+        # The whole design mode updates existing .d files as well, so make
+        # doesn't need to run again for each out of date .d file
+        if (not args.whole_design and os.path.exists(fname)):
             print(f"End recursion for {dep}, already exists")
             continue
-        seen_deps.append(dep)
+        seen_deps.add(dep)
         # Recurse through deps
-        write_depfile(dep, filelist, subs_dict, args)
+        write_depfile(dep, name_index, subs_dict, args, keys, active)
     for prefix in prefixes:
         ostrings[prefix] += "\n"
         dstrings[prefix] += "\n"
 
     for prefix in prefixes:
         fname = os.path.join(args.outdir, f"{name}.{prefix}.d")
-        open(fname, 'w').write(ostrings[prefix] + "\n"
-                               + dstrings[prefix] + "\n"
-                               + istrings[prefix] + "\n"
-                               + dep_var_string + ")\n"
-                               + incl_var_string + ")\n")
+        dtext = (ostrings[prefix] + "\n"
+                 + dstrings[prefix] + "\n"
+                 + istrings[prefix] + "\n"
+                 + dep_var_string + ")\n"
+                 + incl_var_string + ")\n")
+        touch_stamp(name, prefix, args)
+        if not write_text(fname, dtext):
+            print(f"Dependencies unchanged for {name}, keeping {fname}")
+    dep_trace.add(name, 'module', start, dep_trace.now() - start, path=path,
+                  depth=len(active) - 1, deps=len(deps))
 
 
-def main(args):
-    # Figure out path to prefix each repo-relative path with
-    if not os.path.isdir(args.srcbase):
-        sys.exit(1)
-
-    # Ensure outdir exists
-    os.makedirs(args.outdir, exist_ok=True)
-
+def build_filelist(args):
+    ''' List the HDL files of all source directories, with ignores applied'''
     # Add extra directories to srcbase directory
     srcdirs = [args.srcbase]
     if args.extrasubdirs:
         srcdirs += [d.strip() for d in args.extrasubdirs.split()]
 
-    # Create filelist from all source directories
+    # Create filelist from all source directories, using the saved index
+    # to skip listing directories that haven't changed since the last run
+    srcfiles = srcdir_files(srcdirs, args.ignorefile, args.indexfile)
     filelist = []
     for srcdir in srcdirs:
-        # Choose git command if the srcdir is the base of a repo
-        if (os.path.isdir(f"{srcdir}/.git")):
-            fcmd = filelist_git_cmd.format(srcbase=srcdir,
-                                           ignorefile=args.ignorefile)
-        else:
-            fcmd = filelist_find_cmd.format(srcbase=srcdir,
-                                            ignorefile=args.ignorefile)
-        filelist += [os.path.join(srcdir, ii.strip())
-                     for ii in os.popen(fcmd).readlines()
+        # Git lists repo relative paths, find lists full paths
+        git_base = is_git_base(srcdir)
+        filelist += [ii for ii in srcfiles[srcdir]
                      # Don't add duplicate files from extra srcdirs
-                     if not [ff for ff in filelist if ii.strip() in ff]]
+                     if not [ff for ff in filelist
+                             if (os.path.relpath(ii, srcdir) if git_base
+                                 else ii) in ff]]
 
     # Git lists duplicates, so set filter it
     filelist = list(set(filelist))
@@ -208,18 +323,55 @@ def main(args):
         for d in dirs:
             files = [os.path.join(d, f) for f in os.listdir(d)]
             filelist += files
+    return filelist
+
+
+def main(args):
+    # Figure out path to prefix each repo-relative path with
+    if not os.path.isdir(args.srcbase):
+        sys.exit(1)
+
+    # Ensure outdir exists
+    os.makedirs(args.outdir, exist_ok=True)
+
+    name = args.name
+    if args.tracedir:
+        dep_trace.start(args.tracedir, name)
+    start = dep_trace.now()
+
+    with dep_trace.span('file list', 'step') as info:
+        filelist = build_filelist(args)
+        info['files'] = len(filelist)
 
     subs_dict = {}
     if args.subsfilelist:
-        subs_dict = parse_subs_yaml(args.subsfilelist, args.srcbase)
+        with dep_trace.span('substitutions', 'step'):
+            subs_dict = parse_subs_yaml(args.subsfilelist, args.srcbase)
 
-    name = args.name
+    with dep_trace.span('load parse cache', 'step'):
+        parse_cache.update(load_parse_cache(args.parsecache))
+    cache_size = len(parse_cache)
 
-    write_depfile(name, filelist, subs_dict, args)
+    with dep_trace.span('name index', 'step'):
+        name_index = build_name_index(filelist)
+
+    keys = {}
+    if args.jobs > 1:
+        with dep_trace.span('prefetch', 'step', jobs=args.jobs):
+            keys = prefetch_deps(name, name_index, subs_dict, args)
+    with dep_trace.span('write depfiles', 'step'):
+        write_depfile(name, name_index, subs_dict, args, keys)
+    # Only new parse results are worth saving
+    if args.parsecache and len(parse_cache) > cache_size:
+        with dep_trace.span('save parse cache', 'step'):
+            save_parse_cache(args.parsecache, parse_cache,
+                             args.parsecachesize)
     print(f"Processed dependencies for {name}, wrote to {args.outdir}")
+    dep_trace.add(name, 'run', start, dep_trace.now() - start)
+    dep_trace.save()
 
 
-if __name__ == '__main__':
+def get_args(argv=None):
     argp = argparse.ArgumentParser(
         description='Create dependency makefiles for all dependencies of named'
         ' module, using files in current repo and extradirs parameter')
@@ -241,6 +393,27 @@ if __name__ == '__main__':
                       "name will be ignored (default:.ignore_build_system)")
     argp.add_argument('--ignoredirs', help="comma-separated list of "
                       "directories to be ignored")
+    argp.add_argument('--indexfile', help="location to save the index of "
+                      "source files between runs (default: no index)")
+    argp.add_argument('--parsecache', help="location to save parse results "
+                      "of file contents between runs (default: no cache)")
+    argp.add_argument('--parsecachesize', type=int, default=20000,
+                      help="number of parse results to keep (default:20000)")
+    argp.add_argument('--whole-design', action='store_true',
+                      help="update .d files of every dependency in one run, "
+                      "instead of stopping at .d files that already exist")
+    argp.add_argument('--stampdir', help="touch a .deps.done stamp here for "
+                      "each .d file written and make it the target that "
+                      "depends on the source (default: the .d file)")
+    argp.add_argument('-j', '--jobs', type=int, default=1,
+                      help="number of processes used to parse files "
+                      "(default:1)")
+    argp.add_argument('--tracedir', help="write a trace of where the time "
+                      "goes to this directory, see dep_trace.py "
+                      "(default: no trace)")
     argp.add_argument('-d', '--debug', action='store_true', help='print debug')
-    args = argp.parse_args()
-    main(args)
+    return argp.parse_args(argv)
+
+
+if __name__ == '__main__':
+    main(get_args())
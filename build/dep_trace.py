@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from glob import glob
+from collections import Counter
+
+# Trace events of this process in Chrome trace format, None when not tracing
+events = None
+trace_file = None
+# Lookup and cache counters, always kept since they cost little
+counts = Counter()
+
+
+def now():
+    ''' Trace time in microseconds. The monotonic clock is shared by all
+        processes, so runs and pool workers line up when traces are merged.'''
+    return time.monotonic_ns() // 1000
+
+
+def start(tracedir, name):
+    ''' Trace this run, writing to tracedir when save is called '''
+    global events, trace_file
+    os.makedirs(tracedir, exist_ok=True)
+    trace_file = os.path.join(tracedir, f"deps_{name}_{os.getpid()}.jsonl")
+    events = []
+
+
+def add(name, cat, ts, dur, tid=None, **args):
+    ''' Record a complete event, tid is the worker pid for pool results '''
+    if events is None:
+        return
+    pid = os.getpid()
+    events.append({'name': name, 'cat': cat, 'ph': 'X', 'ts': ts, 'dur': dur,
+                   'pid': pid, 'tid': tid or pid, 'args': args})
+
+
+@contextlib.contextmanager
+def span(name, cat, **args):
+    ''' Trace the time spent in a with block
+        The yielded args dict can be updated with results inside the block.'''
+    ts = now()
+    try:
+        yield args
+    finally:
+        add(name, cat, ts, now() - ts, **args)
+
+
+def count(name, num=1):
+    counts[name] += num
+
+
+def save():
+    ''' Write this run's events and counters as JSON lines '''
+    if events is None:
+        return
+    pid = os.getpid()
+    events.append({'name': 'counts', 'ph': 'C', 'ts': now(), 'pid': pid,
+                   'tid': pid, 'args': dict(counts)})
+    tmpfile = f"{trace_file}.tmp"
+    with open(tmpfile, 'w') as trace:
+        for event in events:
+            trace.write(json.dumps(event) + "\n")
+    os.replace(tmpfile, trace_file)
+
+
+def load_traces(tracedir):
+    merged = []
+    for fname in sorted(glob(os.path.join(tracedir, "*.jsonl"))):
+        with open(fname, 'r') as trace:
+            merged += [json.loads(line) for line in trace if line.strip()]
+    merged.sort(key=lambda e: (e['ts'], -e.get('dur', 0)))
+    return merged
+
+
+def build_tree(spans):
+    ''' Nest the module spans of one process by time, adding 'children'
+        and 'self' (time not spent in child modules). Returns the roots.'''
+    roots = []
+    stack = []
+    for span_event in spans:
+        span_event['children'] = []
+        span_event['self'] = span_event['dur']
+        end = span_event['ts'] + span_event['dur']
+        while stack and stack[-1]['ts'] + stack[-1]['dur'] < end:
+            stack.pop()
+        if stack:
+            stack[-1]['children'].append(span_event)
+            stack[-1]['self'] -= span_event['dur']
+        else:
+            roots.append(span_event)
+        stack.append(span_event)
+    return roots
+
+
+def critical_path(root):
+    ''' Follow the slowest child from root, the chain that bounds the run '''
+    path = [root]
+    while path[-1]['children']:
+        path.append(max(path[-1]['children'], key=lambda e: e['dur']))
+    return path
+
+
+def ms(usec):
+    return f"{usec / 1000:10.3f} ms"
+
+
+def report(merged, num):
+    runs = [e for e in merged if e.get('cat') == 'run']
+    if not runs:
+        print("No dependency traces found")
+        return 1
+    totals = Counter()
+    for e in merged:
+        if e['ph'] == 'C':
+            totals.update(e['args'])
+    steps = Counter()
+    for e in merged:
+        if e.get('cat') == 'step':
+            steps[e['name']] += e['dur']
+    modules = [e for e in merged if e.get('cat') == 'module']
+    parses = [e for e in merged if e.get('cat') == 'parse']
+    roots = {}
+    for pid in {e['pid'] for e in modules}:
+        spans = [e for e in modules if e['pid'] == pid]
+        roots[pid] = build_tree(spans)
+
+    print(f"Dependency runs: {len(runs)}, "
+          f"total {sum(e['dur'] for e in runs) / 1e6:0.3f} s")
+    for e in runs:
+        print(f"  {ms(e['dur'])}  {e['name']}")
+    print("\nSteps:")
+    for name, dur in steps.most_common():
+        print(f"  {ms(dur)}  {name}")
+    print("\nCounts:")
+    for name, value in sorted(totals.items()):
+        print(f"  {value:10d}  {name}")
+    depth = max([e['args'].get('depth', 0) for e in modules], default=0)
+    print(f"  {depth:10d}  max recursion depth")
+
+    print("\nSlowest modules (time not spent in dependencies):")
+    for e in sorted(modules, key=lambda e: -e['self'])[:num]:
+        print(f"  {ms(e['self'])}  {e['name']}  {e['args'].get('path', '')}")
+    print("\nSlowest parses:")
+    for e in sorted(parses, key=lambda e: -e['dur'])[:num]:
+        print(f"  {ms(e['dur'])}  {e['args'].get('path', e['name'])}"
+              f"  ({e['args'].get('bytes', 0)} bytes)")
+
+    all_roots = [r for pid_roots in roots.values() for r in pid_roots]
+    if all_roots:
+        slowest = max(all_roots, key=lambda e: e['dur'])
+        print("\nCritical path of the slowest run:")
+        for level, e in enumerate(critical_path(slowest)):
+            print(f"  {ms(e['dur'])}  {'  ' * level}{e['name']}")
+    return 0
+
+
+def main(args):
+    merged = load_traces(args.tracedir)
+    if args.output:
+        json.dump({'traceEvents': merged, 'displayTimeUnit': 'ms'},
+                  open(args.output, 'w'))
+        print(f"Wrote {len(merged)} events to {args.output}, open it in "
+              "chrome://tracing or ui.perfetto.dev\n")
+    return report(merged, args.num)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+        description='Merge dependency analysis traces and show where the '
+        'time went')
+    argp.add_argument('tracedir', help="directory of .jsonl traces written "
+                      "by build_dependency_files.py --tracedir")
+    argp.add_argument('-o', '--output', help="write the merged Chrome trace "
+                      "to this file")
+    argp.add_argument('-n', '--num', type=int, default=15,
+                      help="number of slowest modules and parses to show "
+                      "(default:15)")
+    args = argp.parse_args()
+    sys.exit(main(args))
@@ -2,57 +2,90 @@
 import os
 import sys
 import re
+import json
+import mmap
+import hashlib
 import argparse
+from collections import deque
+import dep_trace
 
+# Change when parsing changes, so cached results from older parsers are dropped
+PARSER_VERSION = 3
 
-# Package use pattern
-package_use_re = re.compile('(\w+)::([\*\w]+)')
 
-# Include use pattern
-include_use_re = re.compile('`include\s+["<]([\w/\.\d]+)[">]')
+# Parentheses or brackets nested up to group_depth levels, holding no
+# includes. Port lists are matched as one token instead of one token per
+# character inside them, package uses in them are found after with pkg_re.
+# Each alternative of group_plain starts differently, runs of other
+# characters and line comments can only end where they must, and "plain
+# (group plain)*" has one way to match. So a failed match can't backtrack
+# badly or read a comment as code.
+group_depth = 6
+group_plain = (rb'(?:[^()\[\]"/`]+(?![^()\[\]"/`])'
+               rb'|"(?:[^"\\\n]|\\.)*"'
+               rb'|//[^\n]*(?![^\n])'
+               rb'|/\*(?:[^*]|\*(?!/))*\*/'
+               rb'|/(?![/*])'
+               rb'|`(?!include\b))')
+group_re = rb'[(\[]' + group_plain + rb'*[)\]]'
+for _ in range(group_depth - 1):
+    group_re = (rb'[(\[]' + group_plain + rb'*(?:' + group_re + group_plain
+                + rb'*)*[)\]]')
 
-# Module instance pattern, assuming parentheses contents removed
-module_instance_re = re.compile(r'''
-  (\w+)\s+          # module_identifier
-  (?:\#\s*\(\)\s*)? # optional parameters
-  (\w+)\s*          # instance name
-  \(\)\s*           # port connections
-  (?=;)             # statement end, don't consume
+# Package uses in a group or run, skipping comments, strings and escaped
+# identifiers like token_re does. Those give an empty name. Names only start
+# at the start of a word, so findall doesn't try again inside every word.
+pkg_re = re.compile(rb'''
+    //[^\n]* | /\*.*?(?:\*/|\Z) | "(?:[^"\\\n]|\\.)*"? | \\\S+
+  | (?<!\w)(\w+)::[\*\w]+
   ''', re.DOTALL | re.VERBOSE)
 
-# These can fail with weird comments (like nested), but should be good enough
-comment_line_re = re.compile(r'//.*')
-comment_block_re = re.compile(r'/\*.*?\*/', re.DOTALL)
-# Match literal quoted strings
-quote_re = re.compile(r'".*?"')
-# Enforce space before "#" in modules
-add_space_re = re.compile(r'#\s*\(')
-
-def de_parentheses(text):
-    pstack = 0
-    bstack = 0
-    result = ""
-    last_close = 0
-    for i, c in enumerate(text):
-        if c == '(':
-            if not pstack and not bstack:
-                result += text[last_close:i+1]
-            pstack += 1
-        elif c == '[':
-            if not bstack and not pstack:
-                result += text[last_close:i]
-            bstack += 1
-        elif c == ')' and pstack:
-            last_close = i
-            pstack -= 1
-        elif c == ']' and bstack:
-            last_close = i+1
-            bstack -= 1
-    result += text[last_close:]
-    return result
-
-
-keywords = [
+# Inside parentheses nested deeper than group_depth, only nesting, includes
+# and package uses matter. A run token is anything up to the next comment,
+# string, include or ';', ending after the first closing parentheses or
+# brackets. Openings all come before closings in a run, so the depth after
+# each run, and where the outermost parenthesis closes, are found by counting
+# instead of one token per parenthesis. Groups aren't tried here, a failed
+# group match costs more than the tokens it would save.
+nest_plain = (rb'(?:[^"/`;)\]]+(?![^"/`;)\]]) | /(?![/*])'
+              rb' | `(?!include\b))')
+nest_re = re.compile(rb'''
+    (?P<run>''' + nest_plain + rb'''+[)\]]* | [)\]]+)
+  | `include\s+["<](?P<include>[\w/\.\d]+)[">]
+  | (?P<skip>//[^\n]* | /\*.*?(?:\*/|\Z) | "(?:[^"\\\n]|\\.)*"? | .)
+  ''', re.DOTALL | re.VERBOSE)
+
+# One match per token, the whole file is scanned once from start to end.
+# Comments and strings are matched as single tokens so anything inside them is
+# skipped. Block comments end at the first "*/", they don't nest in verilog.
+token_re = re.compile(rb'''
+    (?P<skip>//[^\n]*                    # line comment
+      | /\*.*?(?:\*/|\Z)                # block comment
+      | "(?:[^"\\\n]|\\.)*"?)          # string, with escaped characters
+  | `include\s+["<](?P<include>[\w/\.\d]+)[">]
+  | \\(?P<escaped>\S+)                  # escaped identifier
+  | (?P<id>\w+)(?:::(?P<item>[\*\w]+))?  # identifier or package use
+  | (?P<group>''' + group_re + rb''')
+  | (?P<punct>[()\[\];\#])
+  | (?P<other>\S)
+  ''', re.DOTALL | re.VERBOSE)
+
+# Longest token sequence that can be a module instance, see add_instance
+max_instance_tokens = 7
+
+
+def source_bytes(path):
+    ''' Map the file contents, so large files are scanned without reading
+        the whole file into memory'''
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return b""
+
+
+keywords = frozenset([
     'accept_on', 'alias', 'always', 'always_comb',
     'always_ff', 'always_latch', 'and', 'assert', 'assign', 'assume',
     'automatic', 'before', 'begin', 'bind', 'bins', 'binsof', 'bit',
@@ -94,50 +127,205 @@ keywords = [
     'untyped', 'use', 'uwire', 'var', 'vectored', 'virtual', 'void',
     'wait', 'wait_order', 'wand', 'weak', 'weak0', 'weak1', 'while',
     'wildcard', 'wire', 'with', 'within', 'wor', 'xnor', 'xor'
-]
+])
+
+
+def add_instance(window, instances):
+    ''' Check the tokens before a ';' for a module instance
+        Parentheses contents are not in window, so an instance looks like
+        "module_name instance_name ( ) ;" or
+        "module_name # ( ) instance_name ( ) ;"'''
+    # Identifiers are bytes, punctuation is str
+    if (len(window) < 4 or window[-1] != ')' or window[-2] != '('
+            or not isinstance(window[-3], bytes)):
+        return
+    if isinstance(window[-4], bytes):
+        mod_name = window[-4]
+    elif (len(window) == max_instance_tokens and window[-4] == ')'
+            and window[-5] == '(' and window[-6] == '#'
+            and isinstance(window[-7], bytes)):
+        mod_name = window[-7]
+    else:
+        return
+    mod_name = mod_name.decode()
+    if mod_name not in keywords:
+        instances.append(mod_name)
+
+
+def parse_deps(text):
+    ''' Parse file contents into lists of (includes, packages, instances)
+        text = file contents as str, bytes, or mmap'''
+    if isinstance(text, str):
+        text = text.encode('utf-8', 'surrogateescape')
+    includes = []
+    packages = []
+    instances = []
+    # Nesting depth of parentheses and brackets, and the outermost one
+    depth = 0
+    outer = None
+    # Tokens outside of parentheses since the last statement
+    window = deque(maxlen=max_instance_tokens)
+    pos = 0
+    while True:
+        match = (nest_re if depth else token_re).search(text, pos)
+        if not match:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'skip':
+            continue
+        elif kind == 'include':
+            includes.append(os.path.basename(match.group(kind).decode()))
+            window.clear()
+        elif kind == 'item':
+            # lastgroup is the package item, the name is the id before it
+            packages.append(match.group('id').decode())
+            window.clear()
+            if match.group(kind) != b'*':
+                window.append(match.group(kind))
+        elif kind == 'run':
+            token = match.group(kind)
+            closings = len(token) - len(token.rstrip(b')]'))
+            depth += token.count(b'(') + token.count(b'[') - closings
+            if depth <= 0:
+                # The outermost parenthesis closed in this run, scan what
+                # follows it with token_re
+                pos = match.end() + depth
+                token = token[:len(token) + depth]
+                depth = 0
+                if outer == b'(':
+                    window.append(')')
+            if b'::' in token:
+                packages += [p.decode() for p in pkg_re.findall(token) if p]
+        elif kind == 'group':
+            # Balanced, so the depth doesn't change
+            token = match.group(kind)
+            if b'::' in token:
+                packages += [p.decode() for p in pkg_re.findall(token) if p]
+            if not depth and token.startswith(b'('):
+                window.append('(')
+                window.append(')')
+        elif depth:
+            # Nothing else inside parentheses matters
+            continue
+        elif kind == 'id' or kind == 'escaped':
+            window.append(match.group(kind))
+        elif kind == 'punct':
+            char = match.group(kind)
+            if char in b'([':
+                depth = 1
+                outer = char
+                if char == b'(':
+                    window.append('(')
+            elif char == b'#':
+                window.append('#')
+            elif char == b';':
+                add_instance(window, instances)
+                window.clear()
+            else:
+                # Unmatched closing parenthesis
+                window.clear()
+        else:
+            window.clear()
+    return (includes, packages, instances)
+
 
+def parse_file(path):
+    return parse_deps(source_bytes(path))
 
-def find_deps(path, name, text, args):
+
+def parse_file_traced(path, cache):
+    ''' Read, hash and parse path for pool workers, returning (key, parse
+        results, (start, duration, pid)) so the parent can cache and trace it
+        The parse results are None when the key is already in cache.'''
+    start = dep_trace.now()
+    text = source_bytes(path)
+    key = text_hash(text)
+    parsed = None if key in cache else parse_deps(text)
+    return key, parsed, (start, dep_trace.now() - start, os.getpid())
+
+
+def text_hash(text):
+    if isinstance(text, str):
+        text = text.encode('utf-8', 'surrogateescape')
+    return hashlib.sha1(text).hexdigest()
+
+
+def load_parse_cache(cachefile):
+    ''' Read saved parse results, an insertion ordered dict of
+        content hash: (includes, packages, instances)'''
+    if not cachefile or not os.path.exists(cachefile):
+        return {}
+    try:
+        saved = json.load(open(cachefile, 'r'))
+    except (OSError, ValueError):
+        return {}
+    if saved.get('version') != PARSER_VERSION:
+        return {}
+    return saved.get('entries', {})
+
+
+def save_parse_cache(cachefile, cache, size):
+    ''' Merge cache into the saved results and keep the newest size entries
+        Other processes may have saved results since this one loaded them,
+        so those are kept unless they are the oldest.'''
+    entries = load_parse_cache(cachefile)
+    for key, value in cache.items():
+        entries.pop(key, None)
+        entries[key] = value
+    keep = list(entries.items())[-size:] if size > 0 else []
+    os.makedirs(os.path.dirname(os.path.abspath(cachefile)), exist_ok=True)
+    tmpfile = f"{cachefile}.{os.getpid()}.tmp"
+    json.dump({'version': PARSER_VERSION, 'entries': dict(keep)},
+              open(tmpfile, 'w'))
+    os.replace(tmpfile, cachefile)
+
+
+def find_deps(path, name, text, args, cache=None):
     ''' Process module contents to determine a list of dependencies
         path = repository relative path to file
         name = module name
         text = file contents
-        args = arg parser object, looking for args.debug'''
+        args = arg parser object, looking for args.debug
+        cache = optional dict of content hash: parse results, updated here
+        Returns dependencies in the order they are first found'''
     #print("Find deps args:", path, name, args)
-    includes = []
-    packages = []
-    instances = []
-    # Remove characters or comments
-    text = comment_line_re.sub('', text)
-    text = comment_block_re.sub('', text)
-    # Get includes
-    include_search = include_use_re.findall(text)
-    if include_search:
-        for include_path in include_search:
-            includes.append(os.path.basename(include_path))
-    # Remove quoted characters (must be preserved for includes)
-    text = quote_re.sub('', text)
-    # Get packages
-    package_search = package_use_re.findall(text)
-    if package_search:
-        for (pkg_name, fname) in package_search:
-            packages.append(pkg_name)
-    # Get instances -- clean up code for instance search first
-    clean_text = add_space_re.sub(' #(', text)
-    clean_text = de_parentheses(clean_text)
-    instance_search = module_instance_re.findall(clean_text)
-    if instance_search:
-        for (mod_name, inst_name) in instance_search:
-            if mod_name not in keywords:
-                instances.append(mod_name)
-    dep_set = {obj for obj in includes + packages + instances if obj != name}
-    return list(dep_set)
+    if cache is None:
+        with dep_trace.span('parse', 'parse', path=path, bytes=len(text)):
+            parsed = parse_deps(text)
+    else:
+        key = text_hash(text)
+        if key in cache:
+            return cached_deps(name, key, cache)
+        with dep_trace.span('parse', 'parse', path=path, bytes=len(text)):
+            parsed = parse_deps(text)
+        dep_trace.count('parse cache misses')
+        cache[key] = parsed
+    return dep_list(name, parsed)
+
+
+def cached_deps(name, key, cache):
+    ''' find_deps for contents already hashed to key and found in cache'''
+    # Move to the end, the most recently used are evicted last
+    parsed = cache.pop(key)
+    cache[key] = parsed
+    dep_trace.count('parse cache hits')
+    return dep_list(name, parsed)
+
+
+def dep_list(name, parsed):
+    ''' Combine (includes, packages, instances) into a list of dependencies
+        A dict keeps first-found order, so .d files don't change between runs'''
+    includes, packages, instances = parsed
+    dep_dict = {obj: None for obj in includes + packages + instances
+                if obj != name}
+    return list(dep_dict)
 
 
 def main(args):
     name = args.name
     path = args.path
-    text = open(path, 'r').read()
+    text = source_bytes(path)
     deps = find_deps(path, name, text, args)
     print(f"{name} dependencies:")
     deps.sort()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import os
+import json
+import argparse
+
+# Git ls-files is faster, but if not using git, this command works
+# {paths} is a space separated list of directories to list, which allows a
+# single stale subtree to be listed again instead of the whole source tree
+filelist_git_cmd = (
+    "cd {srcbase} && git ls-files --cached --modified --others "
+    "--full-name --exclude-standard {paths} | grep -i "
+    "-e '\\.sv$' -e '\\.svh$' -e '\\.v$' -e '\\.vh$' -e {ignorefile}")
+
+filelist_find_cmd = ("find {paths} | grep -i -e '\\.sv$' -e '\\.svh$' "
+                     "-e '\\.v$' -e '\\.vh$' -e {ignorefile}")
+
+INDEX_VERSION = 3
+# Directory stamp for directories holding the ignorefile, see stamp_dirs
+IGNORED = 'ignored'
+
+
+def is_git_base(srcdir):
+    return os.path.isdir(f"{srcdir}/.git")
+
+
+def list_files(srcdir, paths, ignorefile):
+    ''' Run the file list command for paths under srcdir
+        Returned paths are srcdir joined with the path relative to it, the
+        same way os.walk names directories, so they can be matched against
+        the directory stamps. find prints paths with srcdir already on them,
+        like ./a/x.sv, which would become ././a/x.sv if joined as is.'''
+    if is_git_base(srcdir):
+        rel_paths = " ".join(os.path.relpath(p, srcdir) for p in paths)
+        fcmd = filelist_git_cmd.format(srcbase=srcdir, paths=rel_paths,
+                                       ignorefile=ignorefile)
+    else:
+        fcmd = filelist_find_cmd.format(paths=" ".join(paths),
+                                        ignorefile=ignorefile)
+    with os.popen(fcmd) as flist:
+        files = [ii.strip() for ii in flist.readlines()]
+    if not is_git_base(srcdir):
+        files = [os.path.relpath(f, srcdir) for f in files]
+    return [os.path.join(srcdir, f) for f in files]
+
+
+def dir_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def stamp_dirs(root, ignorefile):
+    ''' Record mtime of every directory under root
+        Adding, removing or renaming a file changes the mtime of its directory,
+        so unchanged mtimes mean an unchanged file list. Directories holding
+        the ignorefile are neither timed nor descended, only the ignorefile
+        is checked, so build directories that change constantly (like the
+        one holding this index) don't invalidate the index.'''
+    stamps = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if ignorefile in filenames:
+            stamps[dirpath] = IGNORED
+            dirnames[:] = []
+        else:
+            stamps[dirpath] = dir_mtime(dirpath)
+            dirnames[:] = [d for d in dirnames if d != '.git']
+    return stamps
+
+
+def git_stamp(srcdir):
+    if is_git_base(srcdir):
+        return dir_mtime(os.path.join(srcdir, '.git', 'index'))
+    return None
+
+
+def is_stale(path, stamp, ignorefile):
+    if stamp == IGNORED:
+        return not os.path.exists(os.path.join(path, ignorefile))
+    return dir_mtime(path) != stamp
+
+
+def stale_roots(stamps, ignorefile):
+    ''' Return the minimal list of changed directories, dropping any
+        directory that is already covered by a changed parent'''
+    stale = sorted(d for d, stamp in stamps.items()
+                   if is_stale(d, stamp, ignorefile))
+    roots = []
+    for d in stale:
+        if not any(d.startswith(r + os.path.sep) for r in roots):
+            roots.append(d)
+    return roots
+
+
+def scan_srcdir(srcdir, ignorefile):
+    return {'files': list_files(srcdir, [srcdir], ignorefile),
+            'dirs': stamp_dirs(srcdir, ignorefile),
+            'git': git_stamp(srcdir)}
+
+
+def update_srcdir(entry, srcdir, ignorefile, verbose=True):
+    ''' Bring a cached srcdir entry up to date, rescanning only the subtrees
+        whose directory mtimes have changed since the entry was recorded'''
+    if entry is None or entry['git'] != git_stamp(srcdir):
+        if verbose:
+            print(f"Indexing all files in {srcdir}")
+        return scan_srcdir(srcdir, ignorefile), True
+    roots = stale_roots(entry['dirs'], ignorefile)
+    if not roots:
+        return entry, False
+    if srcdir in roots:
+        if verbose:
+            print(f"Indexing all files in {srcdir}")
+        return scan_srcdir(srcdir, ignorefile), True
+
+    def in_roots(path):
+        return any(path == r or path.startswith(r + os.path.sep)
+                   for r in roots)
+
+    files = [f for f in entry['files'] if not in_roots(f)]
+    dirs = {d: m for d, m in entry['dirs'].items() if not in_roots(d)}
+    existing = [r for r in roots if os.path.isdir(r)]
+    if verbose:
+        print(f"Reindexing {' '.join(roots)}")
+    if existing:
+        files += list_files(srcdir, existing, ignorefile)
+        for root in existing:
+            dirs.update(stamp_dirs(root, ignorefile))
+    return {'files': files, 'dirs': dirs, 'git': entry['git']}, True
+
+
+def load_index(indexfile, ignorefile):
+    ''' Read the saved index, discarding it if it doesn't match this run'''
+    if not indexfile or not os.path.exists(indexfile):
+        return {}
+    try:
+        saved = json.load(open(indexfile, 'r'))
+    except (OSError, ValueError):
+        return {}
+    if (saved.get('version') != INDEX_VERSION
+            or saved.get('ignorefile') != ignorefile):
+        return {}
+    return saved.get('srcdirs', {})
+
+
+def save_index(indexfile, ignorefile, srcdirs):
+    # Many .d rules run at once, so write to a temp file and move into place
+    os.makedirs(os.path.dirname(os.path.abspath(indexfile)), exist_ok=True)
+    tmpfile = f"{indexfile}.{os.getpid()}.tmp"
+    json.dump({'version': INDEX_VERSION, 'ignorefile': ignorefile,
+               'srcdirs': srcdirs}, open(tmpfile, 'w'))
+    os.replace(tmpfile, indexfile)
+
+
+def srcdir_files(srcdirs, ignorefile, indexfile=None, verbose=True):
+    ''' Return a dict of srcdir: [files], reusing the on-disk index when
+        indexfile is given and the directories haven't changed'''
+    saved = load_index(indexfile, ignorefile)
+    entries = {}
+    changed = False
+    for srcdir in srcdirs:
+        entry, updated = update_srcdir(saved.get(srcdir), srcdir, ignorefile,
+                                       verbose)
+        entries[srcdir] = entry
+        changed = changed or updated
+    if indexfile and (changed or set(saved) != set(entries)):
+        save_index(indexfile, ignorefile, entries)
+    return {srcdir: entry['files'] for srcdir, entry in entries.items()}
+
+
+def build_name_index(filelist):
+    ''' Map names to the sorted list of matching paths
+        Module names match a file basename up to the first period, included
+        files (names with a period) match the whole basename'''
+    index = {}
+    for path in sorted(filelist):
+        base = os.path.basename(path)
+        if "." not in base:
+            continue
+        index.setdefault(base, []).append(path)
+        index.setdefault(base.split(".")[0], []).append(path)
+    return index
+
+
+def main(args):
+    srcdirs = [args.srcbase]
+    if args.extrasubdirs:
+        srcdirs += [d.strip() for d in args.extrasubdirs.split()]
+    files = srcdir_files(srcdirs, args.ignorefile, args.indexfile)
+    for srcdir, flist in files.items():
+        print(f"{srcdir}: {len(flist)} files")
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+        description='Create or update the persistent index of HDL source files')
+    argp.add_argument('srcbase', help="path to source root")
+    argp.add_argument('indexfile', help="location of the saved index")
+    argp.add_argument('--extrasubdirs', help="space-separated list of extra "
+                      "full directories to search, honoring ignorefile")
+    argp.add_argument('--ignorefile', nargs='?',
+                      default='.ignore_build_system',
+                      help="directories containing a file with this "
+                      "name will be ignored (default:.ignore_build_system)")
+    args = argp.parse_args()
+    main(args)
@@ -19,6 +19,34 @@ ifndef NUM_TIMING_TRIES
   NUM_TIMING_TRIES := 10
 endif
 
+ifndef TIMING_JOBS
+## tell synth_timing number of seeds to fit at once. The first seed to make timing stops the others.
+  TIMING_JOBS := 1
+endif
+
+## GB of memory one fit needs when `TIMING_JOBS` is more than 1. A new seed only starts when this much memory is free.
+# TIMING_FIT_MEM: set in upper Makefile
+ifdef TIMING_FIT_MEM
+  TIMING_RERUN_PARAM += --fit-mem $(TIMING_FIT_MEM)
+endif
+
+## how synth_timing stages each seed from the mapped project: `reflink` (copy-on-write), `copy`, `auto` (default, reflink when the filesystem supports it, otherwise copy), or `link` (experimental, hardlink large database files)
+# TIMING_STAGE: set in upper Makefile
+ifdef TIMING_STAGE
+  TIMING_RERUN_PARAM += --stage $(TIMING_STAGE)
+endif
+
+ifndef TIMING_PATHS_DB
+## store of the failing paths of every synth_timing seed, read by `timing_paths`
+  TIMING_PATHS_DB := $(BLD_DIR)/timing_paths.db
+endif
+TIMING_RERUN_PARAM += --paths-db $(TIMING_PATHS_DB)
+
+ifndef TIMING_PATHS_QUERY
+## options for `timing_paths`, like `-q sources -q clocks -q slack -n 50`. See `timing_worst_paths.py -h`.
+  TIMING_PATHS_QUERY := -q paths
+endif
+
 presynth_hook := $(DONE_DIR)/presynth_hook.done
 ## target hook to run before any synth work
 $(presynth_hook): | $(DONE_DIR)
@@ -79,19 +107,29 @@ ifdef SYNTH_SUBSTITUTIONS
 endif
 
 # The .d (dependent) targets are to calculate the dependencies of a file
-# The .d recipe is run whenever the sv file changes
-# The sv dependency is added in the .d file itself
+# The .deps.done stamp recipe is run whenever the sv file changes
+# The sv dependency of the stamp is added in the .d file itself
+# The .d file is only rewritten when the dependencies change, so make only
+#   restarts then, and the stamp keeps the check from running again
+# The .d recipe only runs the check when the .d file is missing
 # The '%' becomes the module name
 # The '$*' is replaced by that module name
-$(DEP_DIR)/%.quartus.d: $(SYNTH_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(BLOG_DIR)
-	@if [ -d $(SRC_BASE_DIR) ]; then\
-	  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
-	   "Identifying dependencies for $*$(UPDATE)" \
-	   "$(MAKEDEPEND_CMD) $(SUBS_QUARTUS) $(MAKEDEP_TOOL_QUARTUS) $*" \
-	   $(BLOG_DIR)/dependency_$*_quartus.log; \
-	else \
-	  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
-	fi
+define quartus-deps
+if [ -d $(SRC_BASE_DIR) ]; then\
+  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
+   "Identifying dependencies for $*$(UPDATE)" \
+   "$(MAKEDEPEND_CMD) $(SUBS_QUARTUS) $(MAKEDEP_TOOL_QUARTUS) $*" \
+   $(BLOG_DIR)/dependency_$*_quartus.log; \
+else \
+  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
+fi
+endef
+# make deletes the stamp as an intermediate file of the .d rule otherwise
+.PRECIOUS: $(DONE_DIR)/%.quartus.deps.done
+$(DONE_DIR)/%.quartus.deps.done: $(SYNTH_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(DONE_DIR) $(BLOG_DIR)
+	@$(quartus-deps)
+$(DEP_DIR)/%.quartus.d: $(DONE_DIR)/%.quartus.deps.done
+	@test -f $@ || { $(quartus-deps); }
 
 
 ##################### Include top level ##############################
@@ -208,7 +246,7 @@ $(EXTRA_TCL): $(QUARTUS_FILE) $(XCVR_SETTINGS) | $(DONE_DIR)
 .PHONY: filelist_synth
 ## print list of files used in synth
 filelist_synth: $(DEP_DIR)/$(TOP_SYNTH).quartus.d
-	@grep "\.d:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
+	@grep "\.deps\.done:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
 .PHONY: modules_synth
 ## print list of modules used in synth
 modules_synth: $(DEP_DIR)/$(TOP_SYNTH).quartus.d
@@ -533,12 +571,18 @@ run_timing_rpt: | $(SYNTH_DIR)
 
 
 # Path for synth_timing. To specify num tries: override NUM_TIMING_TRIES
+# Seeds fitted at once run in copies of SYNTH_DIR, the failed one's log is kept
+ifeq (1,$(TIMING_JOBS))
+  TIMING_FIT_ERRORS := $(PROJECT).fit.rpt
+else
+  TIMING_FIT_ERRORS := $(SYNTH_DIR)_failed.log
+endif
 .PHONY: fit_timing
 ## target to run fit until timing is made
 fit_timing: $(DONE_DIR)/fit_timing.done
 $(DONE_DIR)/fit_timing.done: $(DONE_DIR)/merge.done
 	@echo -e "$O Timing Fit, $(NUM_TIMING_TRIES) tries (started $(DATE)) $C"
-	@$(HDL_BUILD_PATH)/intel/timing_rerun.py $(SYNTH_DIR) $(PROJECT) $(DONE_DIR)/map.done -n $(NUM_TIMING_TRIES) || (grep --color -i "Error (|Critical Warning (" $(PROJECT).fit.rpt && false)
+	@$(HDL_BUILD_PATH)/intel/timing_rerun.py $(SYNTH_DIR) $(PROJECT) $(DONE_DIR)/map.done -n $(NUM_TIMING_TRIES) -j $(TIMING_JOBS) $(TIMING_RERUN_PARAM) || (grep --color -i "Error (|Critical Warning (" $(TIMING_FIT_ERRORS) && false)
 	@touch $(DONE_DIR)/fit.done
 	@touch $(DONE_DIR)/timing.done
 	@touch $@
@@ -641,6 +685,11 @@ timing_rpt: $(TIMING_RPT_FILE)
 timing_rpt_timing: $(DONE_DIR)/timing_timing.done
 	-@cat $(TIMING_RPT_FILE)
 
+.PHONY: timing_paths
+## target to print the most frequent failing timing paths of all synth_timing seeds so far
+timing_paths:
+	@$(HDL_BUILD_PATH)/intel/timing_worst_paths.py --dir $(BLD_DIR) --db $(TIMING_PATHS_DB) $(TIMING_PATHS_QUERY)
+
 # Search the timing report for error lines and exit error if found
 .PHONY: timing_check_all
 ## target to report timing problems
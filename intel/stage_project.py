@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import os
+import stat
+import shutil
+import sys
+import argparse
+import subprocess
+from fnmatch import fnmatch
+
+# Files a fit or timing run may rewrite in place. These are always copied so
+# the mapped snapshot can't change under a linked work directory. Anything
+# smaller than COPY_BELOW is copied too, it costs little and covers small
+# database index files.
+COPY_PATTERNS = ['*.qsf', '*.qpf', '*.qws', '*.sdc', '*.tcl', '*.done',
+                 '*.rpt', '*.summary', '*.smsg', '*.txt', '*.log']
+COPY_BELOW = 1 << 20
+
+STAGE_MODES = ['auto', 'reflink', 'link', 'copy']
+
+
+def must_copy(relpath, size):
+    name = os.path.basename(relpath)
+    return size < COPY_BELOW or any(fnmatch(name, p) for p in COPY_PATTERNS)
+
+
+def snapshot_files(map_dir):
+    ''' Yield (relative path, stat) of every file under map_dir '''
+    for dirpath, dirnames, filenames in os.walk(map_dir):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            yield os.path.relpath(path, map_dir), os.lstat(path)
+
+
+def reflink_works(map_dir):
+    ''' Check that the filesystem of map_dir can make copy-on-write copies '''
+    for relpath, st in snapshot_files(map_dir):
+        if stat.S_ISREG(st.st_mode):
+            test = f"{map_dir}.reflink_test"
+            result = subprocess.run(['cp', '--reflink=always',
+                                     os.path.join(map_dir, relpath), test],
+                                    capture_output=True)
+            if os.path.exists(test):
+                os.remove(test)
+            return result.returncode == 0
+    return False
+
+
+def choose_mode(mode, map_dir):
+    ''' auto only picks modes that give each seed a full private copy. link
+        relies on COPY_PATTERNS naming every file a fit rewrites in place,
+        which hasn't been checked against every Quartus version, so it has
+        to be asked for.'''
+    if mode == 'auto':
+        return 'reflink' if reflink_works(map_dir) else 'copy'
+    return mode
+
+
+def protect_snapshot(map_dir):
+    ''' Make the files that will be linked read-only
+        An in-place write through a link would change the snapshot and every
+        other seed using it, read-only makes that write fail instead. Returns
+        {relative path: (mode, size, mtime)} to check and restore later.'''
+    protected = {}
+    for relpath, st in snapshot_files(map_dir):
+        if stat.S_ISREG(st.st_mode) and not must_copy(relpath, st.st_size):
+            os.chmod(os.path.join(map_dir, relpath), st.st_mode & ~0o222)
+            protected[relpath] = (st.st_mode, st.st_size, st.st_mtime_ns)
+    return protected
+
+
+def link_farm(map_dir, work_dir, protected):
+    ''' Recreate map_dir as real directories, linking the protected files
+        and copying the rest'''
+    for dirpath, dirnames, filenames in os.walk(map_dir):
+        rel_dir = os.path.relpath(dirpath, map_dir)
+        os.makedirs(os.path.join(work_dir, rel_dir), exist_ok=True)
+        for fname in filenames:
+            relpath = os.path.normpath(os.path.join(rel_dir, fname))
+            src = os.path.join(map_dir, relpath)
+            dst = os.path.join(work_dir, relpath)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+                continue
+            if relpath in protected:
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    # Different filesystem or no link support, copy it
+                    pass
+            shutil.copy2(src, dst)
+            if relpath in protected:
+                os.chmod(dst, protected[relpath][0])
+
+
+def stage(map_dir, work_dir, mode, protected):
+    ''' Make work_dir a fresh copy of map_dir, return True on success
+        mode is one of STAGE_MODES other than auto'''
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    if mode == 'link':
+        link_farm(map_dir, work_dir, protected)
+        return True
+    cmd = ['cp', '-a', map_dir, work_dir]
+    if mode == 'reflink':
+        cmd.insert(2, '--reflink=always')
+    return subprocess.run(cmd, capture_output=True).returncode == 0
+
+
+def changed_files(map_dir, protected):
+    ''' Return linked snapshot files that were written since protect_snapshot
+        If any are found, the fit rewrites files this module links, and
+        COPY_PATTERNS needs to include them.'''
+    changed = []
+    for relpath, (_, size, mtime) in protected.items():
+        st = os.stat(os.path.join(map_dir, relpath))
+        if (st.st_size, st.st_mtime_ns) != (size, mtime):
+            changed.append(relpath)
+    return changed
+
+
+def release(work_dir, protected):
+    ''' Restore the permissions of linked files once work_dir is kept '''
+    for relpath, (mode, _, _) in protected.items():
+        path = os.path.join(work_dir, relpath)
+        if os.path.isfile(path):
+            os.chmod(path, mode)
+
+
+def main(args):
+    mode = choose_mode(args.stage, args.map_dir)
+    protected = protect_snapshot(args.map_dir) if mode == 'link' else {}
+    if not stage(args.map_dir, args.work_dir, mode, protected):
+        print(f"Failed to stage {args.map_dir} to {args.work_dir}")
+        return 1
+    release(args.work_dir, protected)
+    release(args.map_dir, protected)
+    print(f"Staged {args.work_dir} with {mode}, {len(protected)} linked files")
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(
+        description='Stage a copy of a mapped Quartus project for a fit')
+    argp.add_argument('map_dir', help="like bld/synth_top_mapped")
+    argp.add_argument('work_dir', help="like bld/synth_top")
+    argp.add_argument('--stage', default='auto', choices=STAGE_MODES,
+                      help="how to stage: reflink (copy-on-write), link "
+                      "(hardlink large database files, experimental), copy, "
+                      "or auto (reflink when the filesystem supports it, "
+                      "otherwise copy), default auto")
+    args = argp.parse_args()
+    sys.exit(main(args))
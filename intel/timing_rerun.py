@@ -3,10 +3,15 @@ import os
 import sys
 import time
 import re
+import difflib
 import argparse
 import random
+import signal
 import subprocess
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Event
+import stage_project
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 # Prepare slack history
@@ -18,6 +23,14 @@ bad_timing_re = re.compile(r"Worst-case setup slack is -([0-9.]+)")
 seed_str = "set_global_assignment -name SEED "
 
 REAL_RUN = True
+# How seed runs are staged from the mapped project, see stage_project.py
+stage_mode = 'copy'
+# Snapshot files hardlinked into each seed run when stage_mode is link
+linked = {}
+# Longest pretend fit in seconds when not REAL_RUN
+FAKE_FIT_TIME = float(os.environ.get('FAKE_FIT_TIME', 2.0))
+# Seconds between checks for finished fits, cancellation and free memory
+POLL_TIME = 0.5
 
 
 def get_args():
@@ -30,45 +43,106 @@ def get_args():
                         help="max number of fits to run, default 10")
     parser.add_argument('-d', '--debug', action='store_true',
                         help="Don't really run Quartus commands for debug")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help="number of seeds to fit at once, default 1")
+    parser.add_argument('--fit-mem', default=0, type=float,
+                        help="GB of memory one fit needs. A new fit only "
+                        "starts when this much memory is available, "
+                        "default 0 (don't check)")
+    parser.add_argument('--stagger', default=60, type=float,
+                        help="seconds between fit starts when --fit-mem is "
+                        "set, so each fit can grow before memory is checked "
+                        "again, default 60")
+    parser.add_argument('--stage', default='auto',
+                        choices=stage_project.STAGE_MODES,
+                        help="how each seed gets its copy of the mapped "
+                        "project: reflink (copy-on-write), link (hardlink "
+                        "large database files, experimental), copy, or auto "
+                        "(reflink when the filesystem supports it, otherwise "
+                        "copy), default auto")
+    parser.add_argument('--paths-db',
+                        help="also add the timing reports to this "
+                        "timing_worst_paths.py store of all runs")
     args = parser.parse_args()
     return args
 
 
-def run(command):
+def run(command, fatal=True):
     if REAL_RUN:
         result = subprocess.run(command, capture_output=True, shell=True)
         if result.returncode > 0:
             print(f"Failed: {command}")
+            if not fatal:
+                print(result.stderr.decode(errors='ignore'), end='')
+                return result.stdout
             sys.exit(result.returncode)
         return result.stdout
     else:
         ''' This function can be used in place of run to test the flow '''
         if ("quartus" in command):
-            path = command.split()[-1]
             print(f"Pretend {command} just ran...")
-            if "sta" in command:
-                if random.random() < 0.1:
-                    time_str = "Worst-case setup slack is 0.00"
-                elif random.random() < 0.3:
-                    time_str = "Worst-case setup slack is -0.10"
-                else:
-                    time_str = f"Worst-case setup slack is -{random.random()*10}"
-                open(path+".sta.rpt", 'w').write(time_str)
-                open(path.rsplit('/', 1)[0]+"/TQ_fake", 'w').write("!")
-            else:
-                print("SEED: " + open(path + ".qsf").read())
+            print(fake_quartus(command), end='')
         elif ("make" in command):
             print("Timing result here: All good!")
         else:
             print(f"Real fake run {command}")
-            print(os.popen(command).read())
+            output = os.popen(command).read()
+            print(output)
+            return output.encode()
+
+
+def fake_quartus(command):
+    ''' Write the results a Quartus command would leave for the flow and
+        return what it would print'''
+    path = command.split()[-1]
+    if "sta" in command:
+        if random.random() < 0.1:
+            time_str = "Worst-case setup slack is 0.00"
+        elif random.random() < 0.3:
+            time_str = "Worst-case setup slack is -0.10"
+        else:
+            time_str = f"Worst-case setup slack is -{random.random()*10}"
+        open(path+".sta.rpt", 'w').write(time_str)
+        open(path.rsplit('/', 1)[0]+"/TQ_fake", 'w').write("!")
+        paths = [f"; -{random.random():0.3f} ; fake|src{random.randint(0, 3)}"
+                 f" ; fake|dst{random.randint(0, 3)} ; clk ; clk ;\n"
+                 for ii in range(10)]
+        open(path.rsplit('/', 1)[0]+"/TQ_fake_200paths_setup.txt",
+             'w').writelines(paths)
+        return ""
+    else:
+        return "SEED: " + open(path + ".qsf").read() + "\n"
 
 
+def run_cancellable(command, cancel, logfile):
+    ''' Run command in its own process group, stopping it if cancel is set
+        Returns the exit code, or None if the command was cancelled. When not
+        REAL_RUN, Quartus commands are a sleep so they can be cancelled. '''
+    fake = not REAL_RUN and "quartus" in command
+    cmd = f"sleep {random.uniform(0, FAKE_FIT_TIME):0.2f}" if fake else command
+    with open(logfile, 'a') as log:
+        log.write(f"\n{time.ctime()}: {command}\n")
+        log.flush()
+        proc = subprocess.Popen(cmd, shell=True, stdout=log,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        while True:
+            try:
+                proc.wait(timeout=POLL_TIME)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.wait()
+                    return None
+    if fake and proc.returncode == 0:
+        open(logfile, 'a').write(fake_quartus(command))
+    return proc.returncode
 
 
 def check_map_present(syn_dir, project, map_dir, map_done):
     if os.path.exists(map_dir):
-        run(f'rm -r {map_dir}')
+        run(f'rm -rf {map_dir}')
     if os.path.exists(map_done):
         # Move this map result to a saved place to restore before each fit
         # TODO: is this step needed?
@@ -93,6 +167,68 @@ def check_bad_timing(project):
         return True
 
 
+def set_seed(project, seed):
+    qsf = open(f'{project}.qsf', 'r').read()
+    qsf = re.sub(rf"{seed_str}\d+", f"{seed_str}%d" % (seed), qsf)
+    # Replace the file rather than write it, in case it is linked
+    open(f'{project}.qsf.tmp', 'w').write(qsf)
+    os.replace(f'{project}.qsf.tmp', f'{project}.qsf')
+
+
+def fit_commands(project):
+    return [f"quartus_fit --read_settings_files=on --write_settings_files=off {project}",
+            f"quartus_sta {project}"]
+
+
+def stage_run(map_dir, run_dir):
+    ''' Stage the mapped project in run_dir, return True on success'''
+    return stage_project.stage(map_dir, run_dir, stage_mode, linked)
+
+
+def snapshot_changed(map_dir):
+    changed = stage_project.changed_files(map_dir, linked)
+    if changed:
+        print("Fit wrote to linked files of the mapped project, rerun with "
+              f"--stage copy: {' '.join(changed)}")
+    return bool(changed)
+
+
+def save_bad_result(run_dir, run_project, map_dir, tmp_dir, slack):
+    ''' Keep the TQ reports and .qsf diff of a failing run in tmp_dir and
+        delete the rest of run_dir'''
+    pslack = f"{slack:0.3f}"
+    print(f"Previous slack was -{pslack} ns")
+    slack_history.append(str(slack))
+    project_name = os.path.basename(run_project)
+    # Don't overwrite existing result, make a unique name
+    if (os.path.exists(f"{tmp_dir}/TQ_{pslack}_{project_name}.qsf.diff")):
+        pslack = f"{pslack}_{time.time()}"
+    # Save timing results to tmp_dir
+    for fname in glob(f"{run_dir}/TQ*"):
+        new_fname = os.path.basename(fname).replace('TQ', f'TQ_{pslack}')
+        os.rename(fname, os.path.join(tmp_dir, new_fname))
+    # Save what this run changed in the settings, like the SEED
+    map_qsf = os.path.join(map_dir, os.path.relpath(run_project, run_dir))
+    diff = difflib.unified_diff(open(f"{map_qsf}.qsf", 'r').readlines(),
+                                open(f"{run_project}.qsf", 'r').readlines(),
+                                f"{map_qsf}.qsf", f"{run_project}.qsf")
+    open(f"{tmp_dir}/TQ_{pslack}_{project_name}.qsf.diff", 'w').writelines(diff)
+    run(f'rm -rf {run_dir}')
+
+
+def finish_met_timing(syn_dir, map_dir, tmp_dir):
+    print("Met timing")
+    stage_project.release(syn_dir, linked)
+    # Move timing results to final dir
+    for fname in glob(f'{tmp_dir}/TQ*'):
+        os.rename(fname, fname.replace(f'{tmp_dir}', f'{syn_dir}'))
+    run(f'rm -rf {tmp_dir}')
+    # Delete unneeded bad results
+    for dname in glob(f'{syn_dir}_*'):
+        run(f'rm -rf {dname}')
+    run(f'rm -rf {map_dir}')
+
+
 def build_for_timing(syn_dir, project, map_dir, tmp_dir, num_runs):
     if os.path.exists(tmp_dir):
         run(f'rm -r {tmp_dir}')
@@ -103,56 +239,158 @@ def build_for_timing(syn_dir, project, map_dir, tmp_dir, num_runs):
         print("\n\nRunning through seed %d" % seed)
         print(time.ctime(), flush=True)
 
-        # Copy mapped directory over, change the SEED, start fit
-        if (os.path.exists(syn_dir)):
-            os.system('rm -rf ' + syn_dir)
-        run(f'cp -a {map_dir} {syn_dir}')
-        # Tweak seed
-        qsf = open(f'{project}.qsf', 'r').read()
-        qsf = re.sub(rf"{seed_str}\d+", f"{seed_str}%d" % (seed), qsf)
-        open(f'{project}.qsf', 'w').write(qsf)
+        # Stage mapped directory, change the SEED, start fit
+        if not stage_run(map_dir, syn_dir):
+            print(f"Failed to stage {map_dir} to {syn_dir}")
+            sys.exit(1)
+        set_seed(project, seed)
         # Do build
-        run(f"quartus_fit --read_settings_files=on --write_settings_files=off {project}")
-        run(f"quartus_sta {project}")
+        for command in fit_commands(project):
+            run(command)
+        if snapshot_changed(map_dir):
+            sys.exit(1)
 
         slack = check_bad_timing(project)
 
         if slack:
             if (type(slack) is float):
-                pslack = f"{slack:0.3f}"
-                print(f"Previous slack was -{pslack} ns")
-                slack_history.append(str(slack))
-                # Backup bad build
-                new_dir = syn_dir + f"_{pslack}"
-                # Don't overwrite existing result, make a unique name
-                if (os.path.exists(new_dir)):
-                    new_dir = f"{new_dir}_{time.time()}"
-                    pslack = f"{pslack}_{time.time()}"
-                os.rename(syn_dir, new_dir)
-                # Save timing results to tmp_dir
-                for fname in glob(f"{new_dir}/TQ*"):
-                    new_fname = fname.replace(f'{new_dir}', f'{tmp_dir}')
-                    new_fname = new_fname.replace('TQ', f'TQ_{pslack}')
-                    os.rename(fname, new_fname)
+                save_bad_result(syn_dir, project, map_dir, tmp_dir, slack)
             else:
                 print(f"Some problem with slack detection? {slack}")
 
 
         # No timing slack, done
         else:
-            print("Met timing")
-            # Move timing results to final dir
-            for fname in glob(f'{tmp_dir}/TQ*'):
-                os.rename(fname, fname.replace(f'{tmp_dir}', f'{syn_dir}'))
-            run(f'rm -rf {tmp_dir}')
-            # Delete unneeded bad results
-            for dname in glob(f'{syn_dir}_*'):
-                run(f'rm -rf {dname}')
-            run(f'rm -rf {map_dir}')
+            finish_met_timing(syn_dir, map_dir, tmp_dir)
             return True
     return False
 
 
+def mem_available():
+    ''' Return available memory in GB, or None if it can't be read '''
+    try:
+        for line in open('/proc/meminfo', 'r'):
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) / 1024 / 1024
+    except OSError:
+        pass
+    return None
+
+
+def fit_seed(seed, work_dir, project, map_dir, cancel):
+    ''' Fit one seed in its own copy of the mapped project
+        Returns (status, value): ("slack", check_bad_timing result),
+        ("failed", exit code) or ("cancelled", None)'''
+    logfile = f"{work_dir}.log"
+    if not stage_run(map_dir, work_dir):
+        print(f"Failed to stage {map_dir} to {work_dir}")
+        return "failed", 1
+    set_seed(project, seed)
+    for command in fit_commands(project):
+        returncode = run_cancellable(command, cancel, logfile)
+        if returncode is None:
+            return "cancelled", None
+        if returncode > 0:
+            print(f"Failed: {command} (see {logfile})")
+            return "failed", returncode
+    if snapshot_changed(map_dir):
+        return "failed", 1
+    return "slack", check_bad_timing(project)
+
+
+def clean_seed_runs(syn_dir, keep=None):
+    ''' Remove the syn_dir_seed<N> work directories and logs of seeds that
+        are finished or were cancelled, except the work directory keep'''
+    for name in glob(f'{syn_dir}_seed*'):
+        if name != keep:
+            run(f'rm -rf {name}')
+
+
+def build_for_timing_parallel(syn_dir, project, map_dir, tmp_dir, num_runs,
+                              jobs, fit_mem, stagger):
+    ''' Like build_for_timing, but fit up to jobs seeds at once, each in a
+        syn_dir_seed<N> work directory. The first seed to meet timing becomes
+        syn_dir and the fits still running are stopped. If a fit fails, its
+        work directory is kept and its log is moved to syn_dir_failed.log.'''
+    if os.path.exists(tmp_dir):
+        run(f'rm -r {tmp_dir}')
+    os.mkdir(tmp_dir)
+    if os.path.exists(f"{syn_dir}_failed.log"):
+        os.remove(f"{syn_dir}_failed.log")
+    initial_seed = random.randint(1, 4096)  # is there a max number for SEED?
+    pending = list(range(initial_seed, initial_seed + num_runs))
+    project_path = os.path.relpath(project, syn_dir)
+    cancel = Event()
+    running = {}
+    winner = None
+    failed = None
+    error = 0
+    last_start = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        # Fits run in their own sessions, so Ctrl-C and errors here must
+        # stop them before the pool waits for its threads to finish
+        try:
+            while running or (pending and not cancel.is_set()):
+                # Admit new fits while there are free workers and memory
+                while pending and not cancel.is_set() and len(running) < jobs:
+                    if running and fit_mem:
+                        available = mem_available()
+                        if (time.time() - last_start < stagger
+                                or (available is not None
+                                    and available < fit_mem)):
+                            break
+                    seed = pending.pop(0)
+                    work_dir = f"{syn_dir}_seed{seed}"
+                    print(f"\n\nRunning through seed {seed} in {work_dir}")
+                    print(time.ctime(), flush=True)
+                    work_project = os.path.join(work_dir, project_path)
+                    future = pool.submit(fit_seed, seed, work_dir,
+                                         work_project, map_dir, cancel)
+                    running[future] = (seed, work_dir, work_project)
+                    last_start = time.time()
+                done, _ = wait(running, timeout=POLL_TIME,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    seed, work_dir, work_project = running.pop(future)
+                    status, value = future.result()
+                    if status == "failed":
+                        if not error:
+                            error = value
+                            failed = work_dir
+                        cancel.set()
+                    elif status == "slack":
+                        print(f"\nSeed {seed} finished {time.ctime()}")
+                        if value and type(value) is float:
+                            save_bad_result(work_dir, work_project, map_dir,
+                                            tmp_dir, value)
+                        elif value:
+                            print("Some problem with slack detection? "
+                                  f"{value}")
+                        elif winner is None:
+                            print(f"Seed {seed} met timing, stopping "
+                                  "other fits")
+                            winner = work_dir
+                            cancel.set()
+        except BaseException:
+            cancel.set()
+            raise
+    if error:
+        if os.path.exists(f"{failed}.log"):
+            os.replace(f"{failed}.log", f"{syn_dir}_failed.log")
+            print(f"Log of the failed fit is {syn_dir}_failed.log")
+        clean_seed_runs(syn_dir, keep=failed)
+        sys.exit(error)
+    if winner is None:
+        clean_seed_runs(syn_dir)
+        return False
+    if os.path.exists(syn_dir):
+        run(f'rm -rf {syn_dir}')
+    os.rename(winner, syn_dir)
+    os.rename(f"{winner}.log", os.path.join(syn_dir, 'timing_rerun.log'))
+    finish_met_timing(syn_dir, map_dir, tmp_dir)
+    return True
+
+
 def main():
     args = get_args()
     if args.debug:
@@ -163,11 +401,27 @@ def main():
     map_dir = syn_dir + "_mapped"
     tmp_dir = syn_dir + "_results"
     check_map_present(syn_dir, args.project, map_dir, args.mapdonefile)
-    timing_result = build_for_timing(syn_dir, args.project,
-                                     map_dir, tmp_dir, args.num)
+    global stage_mode, linked
+    stage_mode = stage_project.choose_mode(args.stage, map_dir)
+    if stage_mode == 'link':
+        linked = stage_project.protect_snapshot(map_dir)
+    print(f"Staging seed runs with {stage_mode}")
+    if args.jobs > 1:
+        timing_result = build_for_timing_parallel(
+            syn_dir, args.project, map_dir, tmp_dir, args.num, args.jobs,
+            args.fit_mem, args.stagger)
+    else:
+        timing_result = build_for_timing(syn_dir, args.project,
+                                         map_dir, tmp_dir, args.num)
     # Clean up and report
     run(f'rm -rf {map_dir}')
-    worst = run(script_dir + '/timing_worst_paths.py').decode(errors='ignore')
+    # The seed reports are next to syn_dir, and a problem with the path
+    # store shouldn't fail a fit that already finished
+    worst_cmd = (script_dir + '/timing_worst_paths.py --dir '
+                 + os.path.dirname(os.path.abspath(syn_dir)))
+    if args.paths_db:
+        worst_cmd += f' --db {args.paths_db} --current'
+    worst = run(worst_cmd, fatal=False).decode(errors='ignore')
     if slack_history:
         slack_history.sort()
         print("\n")
@@ -2,50 +2,242 @@
 import sys
 import os
 import re
-from collections import Counter
-
-report_size = 20
-
-with os.popen('find . -name "*TQ*_200paths_setup.txt"') as setup_reports:
-    setup_files = setup_reports.read().splitlines()
-
-# remove builds that met timing
-setup_files = [ii for ii in setup_files if "0.000" not in ii]
-if not setup_files:
-    print("Could not find any TimeQuest setup results under current directory")
-    sys.exit(1)
+import math
+import sqlite3
+import hashlib
+import argparse
+from fnmatch import fnmatch
 
+report_pattern = "*TQ*_200paths_setup.txt"
 
+# A good line is "; -0.943 ; name ; name ; clk ; clk ; rel ; skew ; delay;"
+# Split(";")Index: 0   1      2      3      4     5     6     7       8
+SLACK = 1
 SRC = 2
 DST = 3
+FROM_CLK = 4
+TO_CLK = 5
 # Trim up the names so that buses and memory locations are combined
 re_debus = re.compile(r'\[[0-9]+\]')
 re_deram = re.compile(r'ram_block.*?;')
 
-report_lines = []
-for ii in setup_files:
-    # A good line is "; -0.943 ; name ; name ; clk ; clk ; rel ; skew ; delay;"
-    # Split(";")Index: 0   1      2      3      4     5     6     7       8
-    lines = open(ii.strip(), 'r').read().splitlines()
-    # Filter for good lines, and remove extra spaces in the line
-    good_lines = [ll.replace(" ", "") for ll in lines if ll.startswith("; -")]
-    # Clean up all the lines
-    good_lines = [re.sub(re_debus, '', ll) for ll in good_lines]
-    good_lines = [re.sub(re_deram, 'ram_block;', ll) for ll in good_lines]
-    good_lines = [ll.replace("~DUPLICATE", "") for ll in good_lines]
-    # Remove duplicate lines (caused by a single bus reported for each bit)
-    good_lines = set(good_lines)
-    # Add these lines to the total report
-    report_lines += [line.split(";") for line in good_lines]
-
-# report_lines contains an array of values per line of all the reports
-paths = [(ii[SRC], ii[DST]) for ii in report_lines]
-sources = [ii[SRC] for ii in report_lines]
-destinations = [ii[DST] for ii in report_lines]
-
-result = Counter(paths)
-for (path, num) in result.most_common(report_size):
-    print("From: %s" % path[0])
-    print("To  : %s" % path[1])
-    print("Cnt : %d" % num)
+STORE_VERSION = 2
+# A report is known by a hash of its contents, so a copy of it, like the one
+# archived under $(BLD_DIR), isn't counted twice. files remembers the hash of
+# each path, size and mtime seen, so unchanged files aren't read again.
+schema = """
+CREATE TABLE IF NOT EXISTS reports (id INTEGER PRIMARY KEY, hash TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT, size INTEGER, mtime INTEGER, report INTEGER,
+    UNIQUE (path, size, mtime));
+CREATE TABLE IF NOT EXISTS paths (
+    report INTEGER, slack REAL, src TEXT, dst TEXT,
+    from_clk TEXT, to_clk TEXT);
+CREATE INDEX IF NOT EXISTS paths_report ON paths(report);
+"""
+
+# Query name: (grouped columns, labels)
+queries = {
+    'paths': (['src', 'dst'], ["From", "To  "]),
+    'sources': (['src'], ["From"]),
+    'destinations': (['dst'], ["To  "]),
+    'clocks': (['from_clk', 'to_clk'], ["From clock", "To clock  "]),
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description=('Count the most frequent failing paths in TimeQuest '
+                     'setup reports'))
+    parser.add_argument('--dir', default='.',
+                        help="directory to search for reports, default .")
+    parser.add_argument('--db', help="SQLite store of ingested reports. "
+                        "Reports already in the store are only read again "
+                        "if they changed, and results cover every report "
+                        "ingested so far. Without it, only the reports "
+                        "found now are counted.")
+    parser.add_argument('--current', action='store_true',
+                        help="with --db, only count the reports found now")
+    parser.add_argument('--no-scan', action='store_true',
+                        help="with --db, don't search for new reports")
+    parser.add_argument('-q', '--query', action='append',
+                        choices=list(queries) + ['slack'],
+                        help="what to report, can be repeated: paths, "
+                        "sources, destinations, clocks (pairs of launch and "
+                        "latch clocks) or slack (histogram), default paths")
+    parser.add_argument('-n', '--num', default=20, type=int,
+                        help="number of results for each query, default 20")
+    parser.add_argument('--bin', default=0.1, type=float,
+                        help="ns width of a slack histogram bin, default 0.1")
+    args = parser.parse_args()
+    if (args.current or args.no_scan) and not args.db:
+        parser.error("--current and --no-scan need --db")
+    return args
+
+
+def find_reports(top):
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames.sort()
+        for fname in sorted(filenames):
+            path = os.path.join(dirpath, fname)
+            # remove builds that met timing
+            if fnmatch(fname, report_pattern) and "0.000" not in path:
+                yield path
+
+
+def report_paths(fname):
+    ''' Yield the fields of each failing path of a report, one line at a time
+        Names are cleaned up, then lines that became the same are skipped'''
+    seen = set()
+    with open(fname, 'r', errors='ignore') as report:
+        for line in report:
+            if not line.startswith("; -"):
+                continue
+            # Remove extra spaces in the line and clean up the names
+            line = line.rstrip("\n").replace(" ", "")
+            line = re_debus.sub('', line)
+            line = re_deram.sub('ram_block;', line)
+            line = line.replace("~DUPLICATE", "")
+            # Remove duplicate lines (caused by a single bus reported for each bit)
+            if line in seen:
+                continue
+            seen.add(line)
+            fields = line.split(";")
+            yield fields + [''] * (TO_CLK + 1 - len(fields))
+
+
+def open_store(dbfile):
+    db = sqlite3.connect(dbfile or ':memory:', timeout=60)
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, STORE_VERSION):
+        # Written by a different version of this script, start over
+        db.executescript("DROP TABLE IF EXISTS reports;"
+                         "DROP TABLE IF EXISTS files;"
+                         "DROP TABLE IF EXISTS paths;")
+    db.executescript(schema)
+    db.execute(f"PRAGMA user_version = {STORE_VERSION}")
+    return db
+
+
+def slack_value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def file_hash(fname):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as report:
+        for chunk in iter(lambda: report.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ingest(db, fname):
+    ''' Add the paths of report fname to the store unless they are already
+        there, return (report id, True if the report was read)
+        Builds reuse the same names, so a changed file is a new report and
+        the old one stays in the history. A copy of a known report is the
+        same report.'''
+    path = os.path.realpath(fname)
+    st = os.stat(path)
+    row = db.execute("SELECT report FROM files WHERE path = ? AND size = ? "
+                     "AND mtime = ?",
+                     (path, st.st_size, st.st_mtime_ns)).fetchone()
+    if row:
+        return row[0], False
+    digest = file_hash(path)
+    with db:
+        # Another build may add the same report between a check and an
+        # insert, so let the unique hash decide who reads it
+        read = db.execute("INSERT OR IGNORE INTO reports (hash) VALUES (?)",
+                          (digest,)).rowcount == 1
+        report = db.execute("SELECT id FROM reports WHERE hash = ?",
+                            (digest,)).fetchone()[0]
+        if read:
+            db.executemany(
+                "INSERT INTO paths VALUES (?, ?, ?, ?, ?, ?)",
+                ((report, slack_value(f[SLACK]), f[SRC], f[DST], f[FROM_CLK],
+                  f[TO_CLK]) for f in report_paths(fname)))
+        db.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?)",
+                   (path, st.st_size, st.st_mtime_ns, report))
+    return report, read
+
+
+def scan(db, top):
+    ''' Ingest every report under top, return the ids of the reports found'''
+    found = []
+    new = 0
+    for fname in find_reports(top):
+        report, read = ingest(db, fname)
+        if report not in found:
+            found.append(report)
+        new += read
+    return found, new
+
+
+def select_reports(db, found):
+    ''' Limit queries to the found reports, or all reports if found is None
+        Returns the number of reports queries will cover'''
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS selected (id INTEGER)")
+    db.execute("DELETE FROM selected")
+    if found is None:
+        db.execute("INSERT INTO selected SELECT id FROM reports")
+    else:
+        db.executemany("INSERT INTO selected VALUES (?)",
+                       ((ii,) for ii in found))
+    return db.execute("SELECT COUNT(*) FROM selected").fetchone()[0]
+
+
+def print_counts(db, query, num):
+    columns, labels = queries[query]
+    cols = ", ".join(columns)
+    rows = db.execute(
+        f"SELECT {cols}, COUNT(*) AS cnt FROM paths "
+        f"WHERE report IN (SELECT id FROM selected) "
+        f"GROUP BY {cols} ORDER BY cnt DESC, {cols} LIMIT ?", (num,))
+    for row in rows:
+        for label, value in zip(labels, row):
+            print(f"{label}: {value}")
+        print("Cnt : %d" % row[-1])
+        print()
+
+
+def print_histogram(db, width):
+    db.create_function('slack_bin', 1, lambda s: math.floor(s / width))
+    rows = db.execute(
+        "SELECT slack_bin(slack) AS bin, COUNT(*) FROM paths "
+        "WHERE report IN (SELECT id FROM selected) AND slack IS NOT NULL "
+        "GROUP BY bin ORDER BY bin").fetchall()
+    most = max([cnt for _, cnt in rows], default=0)
+    for slack_bin, cnt in rows:
+        low = slack_bin * width
+        bar = "#" * max(1, round(50 * cnt / most))
+        print(f"{low:8.3f} to {low + width:8.3f} ns: {cnt:8d} {bar}")
     print()
+
+
+def main():
+    args = get_args()
+    db = open_store(args.db)
+    found = None
+    if not args.no_scan:
+        found, new = scan(db, args.dir)
+        if args.db:
+            print(f"Found {len(found)} reports, {new} new", file=sys.stderr)
+    if args.db and not args.current:
+        found = None
+    if not select_reports(db, found):
+        print("Could not find any TimeQuest setup results under "
+              + ("current directory" if args.dir == '.' else args.dir))
+        return 1
+    for query in args.query or ['paths']:
+        if query == 'slack':
+            print_histogram(db, args.bin)
+        else:
+            print_counts(db, query, args.num)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -32,19 +32,29 @@ ifdef SIM_SUBSTITUTIONS
 endif
 
 # The .d (dependent) targets are to calculate the dependencies of a file
-# The .d recipe is run whenever the sv file changes
-# The sv dependency is added in the .d file itself
+# The .deps.done stamp recipe is run whenever the sv file changes
+# The sv dependency of the stamp is added in the .d file itself
+# The .d file is only rewritten when the dependencies change, so make only
+#   restarts then, and the stamp keeps the check from running again
+# The .d recipe only runs the check when the .d file is missing
 # The '%' becomes the module name
 # The '$*' is replaced by that module name
-$(DEP_DIR)/%.questa.d: $(SIM_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(BLOG_DIR)
-	@if [ -d $(SRC_BASE_DIR) ]; then\
-	  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
-	   "$(CLEAR)Identifying dependencies for $*$(UPDATE)" \
-	   "$(MAKEDEPEND_CMD) $(SUBS_QUESTA) $(MAKEDEP_TOOL_QUESTA) $*" \
-	   $(BLOG_DIR)/dependency_$*_questa.log; \
-	else \
-	  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
-	fi
+define questa-deps
+if [ -d $(SRC_BASE_DIR) ]; then\
+  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
+   "$(CLEAR)Identifying dependencies for $*$(UPDATE)" \
+   "$(MAKEDEPEND_CMD) $(SUBS_QUESTA) $(MAKEDEP_TOOL_QUESTA) $*" \
+   $(BLOG_DIR)/dependency_$*_questa.log; \
+else \
+  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
+fi
+endef
+# make deletes the stamp as an intermediate file of the .d rule otherwise
+.PRECIOUS: $(DONE_DIR)/%.questa.deps.done
+$(DONE_DIR)/%.questa.deps.done: $(SIM_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(DONE_DIR) $(BLOG_DIR)
+	@$(questa-deps)
+$(DEP_DIR)/%.questa.d: $(DONE_DIR)/%.questa.deps.done
+	@test -f $@ || { $(questa-deps); }
 
 
 ##################### Include top level ##############################
@@ -135,7 +145,7 @@ vopt: comp $(VOPT_DONE)
 .PHONY: filelist_sim
 ## target to print list of files used in sim
 filelist_sim: $(DEP_DIR)/$(SIEMENS_TOP).questa.d
-	@grep "\.d:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
+	@grep "\.deps\.done:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
 .PHONY: modules_sim
 ## target to print list of modules used in sim
 modules_sim: $(DEP_DIR)/$(SIEMENS_TOP).questa.d
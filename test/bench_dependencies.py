@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+build_dir = os.path.join(script_dir, '..', 'build')
+sys.path.insert(0, build_dir)
+import build_dependency_files  # noqa: E402
+from find_dependencies import (  # noqa: E402
+    find_deps, parse_deps, source_bytes)
+from source_index import build_name_index  # noqa: E402
+
+dep_script = os.path.join(build_dir, 'build_dependency_files.py')
+
+pkg_template = """package {name};
+{imports}  localparam int {name}_W = {width};
+  typedef logic [{name}_W-1:0] data_t;
+  typedef struct packed {{
+    data_t data;
+    logic valid;
+  }} bus_t;
+endpackage: {name}
+"""
+
+incl_template = """{includes}`define {guard}_W {width}
+localparam {guard}_DEPTH = {width};
+"""
+
+module_template = """// Generated module {name}, level {level}
+module {name}
+{imports}  #(
+    parameter int W = 8,
+    parameter string NAME = "{name}"
+  ) (
+{ports}
+  );
+{includes}
+{decls}
+{instances}
+endmodule: {name}
+"""
+
+instance_template = """  // {child} instance {num}
+  {child} #(
+    .W(W),
+    .NAME("{child}_{num}")
+  ) u_{child}_{num} (
+{conns}
+  );
+"""
+
+# Statements the lexer has to handle without going one token at a time
+# through parentheses: macros in parameter and port lists, calls nested
+# deeper than find_dependencies.group_depth, and package uses in both
+lexer_cases = {
+    'macros': ("  cell{i} #(.W(`WIDTH), .D(`DEPTH({i}))) u_{i} "
+               "(.a(x[`MSB:0]), .b(y[`IDX({i})]), .c(z));\n"),
+    'nested': ("  assign w{i} = f(g(h(k(m(p(q(a{i}, b[c[d]]), 1))))));\n"
+               "  sub{i} u_{i} (.o(f(g(h(k(m(p(n[1]))))))), .i(x));\n"),
+    'mixed': ("  pkg{i}::t v{i};\n"
+              "  cell{i} #(.P(pkg{i}::P), .W(`W)) u_{i} "
+              "(.a(f(g(h(k(m(p(q(pkg{i}::C)))))))), .b(x[`M:0]));\n"),
+}
+
+
+def lexer_text(case, size):
+    ''' Repeat the statements of a lexer case in one module of about size
+        bytes'''
+    line = lexer_cases[case]
+    count = max(1, size // len(line.format(i=0)))
+    body = "".join(line.format(i=i) for i in range(count))
+    return f"module lexer_{case};\n{body}endmodule\n".encode()
+
+
+def generate_design(outdir, modules, depth, fanout, packages, includes,
+                    ports, seed):
+    ''' Write a synthetic design under outdir and return the top module name
+        Modules are spread over depth levels, each instantiating fanout
+        modules of the next level. Every module imports packages, includes
+        headers, and has a parameterized list of ports.'''
+    rng = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    pkg_names = [f"bench_pkg{i}" for i in range(packages)]
+    incl_names = [f"bench_incl{i}.svh" for i in range(includes)]
+
+    for i, name in enumerate(pkg_names):
+        # Packages build on earlier packages
+        imports = "".join(f"  import {p}::*;\n"
+                          for p in rng.sample(pkg_names[:i], min(i, 2)))
+        text = pkg_template.format(name=name, imports=imports,
+                                   width=rng.randint(1, 64))
+        open(os.path.join(outdir, f"{name}.sv"), 'w').write(text)
+
+    for i, name in enumerate(incl_names):
+        # Headers include later headers, so there are no include loops
+        later = incl_names[i + 1:]
+        incls = "".join(f'`include "{h}"\n'
+                        for h in rng.sample(later, min(len(later), 2)))
+        guard = name.split('.')[0].upper()
+        text = incl_template.format(includes=incls, guard=guard,
+                                    width=rng.randint(1, 64))
+        open(os.path.join(outdir, name), 'w').write(text)
+
+    # Spread modules over the levels, one top module at level 0. A level has
+    # at most fanout times the modules of the level above, so every module
+    # is instantiated somewhere under the top.
+    levels = [["bench_top"]]
+    count = 1
+    for level in range(1, depth):
+        remaining = modules - count
+        size = min(len(levels[-1]) * fanout,
+                   -(-remaining // (depth - level)))
+        if size <= 0:
+            break
+        levels.append([f"bench_mod{count + i}" for i in range(size)])
+        count += size
+
+    port_list = ",\n".join(
+        f"    {'input' if j % 2 else 'output'} logic [W-1:0] p{j}"
+        for j in range(ports))
+    conns = ",\n".join(f"    .p{j}(sig{j}[W-1:0])" for j in range(ports))
+    decls = "\n".join(f"  logic [W-1:0] sig{j};" for j in range(ports))
+    for level, names in enumerate(levels):
+        children = levels[level + 1] if level + 1 < len(levels) else []
+        num_children = min(len(children), fanout)
+        for index, name in enumerate(names):
+            imports = "".join(f"  import {p}::*;\n" for p in rng.sample(
+                pkg_names, min(len(pkg_names), 3)))
+            incls = "".join(f'  `include "{h}"\n' for h in rng.sample(
+                incl_names, min(len(incl_names), 3)))
+            pkg_decls = "".join(f"  {p}::bus_t {p}_bus;\n" for p in rng.sample(
+                pkg_names, min(len(pkg_names), 2)))
+            insts = "".join(
+                instance_template.format(
+                    child=children[(index * fanout + num) % len(children)],
+                    num=num, conns=conns)
+                for num in range(num_children))
+            text = module_template.format(
+                name=name, level=level, imports=imports, ports=port_list,
+                includes=incls, decls=pkg_decls + decls, instances=insts)
+            open(os.path.join(outdir, f"{name}.sv"), 'w').write(text)
+    return "bench_top"
+
+
+@contextlib.contextmanager
+def quiet():
+    ''' The dependency scripts print progress, keep it out of the report'''
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def measure(func, *args):
+    ''' Run func, return (result, seconds, peak traced memory in bytes)
+        Tracing memory slows Python down a lot, so func is run once for time
+        and again for memory.'''
+    start = time.perf_counter()
+    with quiet():
+        result = func(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    with quiet():
+        func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+# Runs build_dependency_files.py like the command line does, then saves the
+# peak RSS and CPU time of that process and of the processes it started, the
+# parse workers with --jobs or the file search otherwise. Measuring from
+# inside the child leaves out the memory of this benchmark, which a forked
+# child starts out sharing. The CPU time of the process itself is the part
+# a pool of workers can't spread over more CPUs.
+rusage_wrapper = """
+import os, sys, json, runpy, resource
+script, usage_file = sys.argv[1:3]
+sys.argv = [script] + sys.argv[3:]
+sys.path.insert(0, os.path.dirname(script))
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    json.dump([[u.ru_maxrss, u.ru_utime + u.ru_stime] for u in usage],
+              open(usage_file, 'w'))
+"""
+
+
+def run_script(dep_args, usage_file):
+    ''' Run build_dependency_files.py, return (seconds, peak RSS in bytes,
+        peak RSS of its largest child in bytes, CPU seconds, CPU seconds of
+        its children)'''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', rusage_wrapper,
+                             dep_script, usage_file] + dep_args,
+                            stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - start
+    if result.returncode:
+        print(f"Failed: {dep_script} {' '.join(dep_args)}")
+        sys.exit(1)
+    # ru_maxrss is kilobytes on Linux
+    (rss, cpu), (child_rss, child_cpu) = json.load(open(usage_file))
+    return seconds, rss * 1024, child_rss * 1024, cpu, child_cpu
+
+
+def bench(args, srcdir, workdir, top):
+    results = {}
+    files = sorted(os.path.join(srcdir, f) for f in os.listdir(srcdir))
+    total_bytes = sum(os.path.getsize(f) for f in files)
+    results['design'] = {'files': len(files), 'bytes': total_bytes}
+
+    def dep_args(outdir, *extra):
+        return list(extra) + [srcdir, outdir, 'questa,quartus', top]
+
+    # File list construction, without and with the saved index
+    indexfile = os.path.join(workdir, 'source_index.json')
+    cold_args = build_dependency_files.get_args(dep_args(workdir))
+    warm_args = build_dependency_files.get_args(
+        dep_args(workdir, '--indexfile', indexfile))
+    filelist, cold, cold_mem = measure(build_dependency_files.build_filelist,
+                                       cold_args)
+    measure(build_dependency_files.build_filelist, warm_args)
+    _, warm, warm_mem = measure(build_dependency_files.build_filelist,
+                                warm_args)
+    results['filelist'] = {'seconds': cold, 'peak_bytes': cold_mem,
+                           'indexed_seconds': warm,
+                           'indexed_peak_bytes': warm_mem,
+                           'files_per_second': len(filelist) / cold}
+
+    # Parsing every file
+    def parse_all():
+        return [find_deps(f, os.path.basename(f).split('.')[0],
+                          source_bytes(f), None) for f in files]
+    _, seconds, peak = measure(parse_all)
+    results['find_deps'] = {'seconds': seconds, 'peak_bytes': peak,
+                            'files_per_second': len(files) / seconds,
+                            'mb_per_second': total_bytes / 1e6 / seconds}
+
+    # Parsing large files the lexer can't match as one token per port list
+    for case in lexer_cases:
+        text = lexer_text(case, args.lexer_kb * 1000)
+        _, seconds, peak = measure(parse_deps, text)
+        results[f"lexer_{case}"] = {'seconds': seconds, 'peak_bytes': peak,
+                                    'mb_per_second': len(text) / 1e6 / seconds}
+
+    # Looking up every file name
+    name_index, index_seconds, _ = measure(build_name_index, filelist)
+    names = [os.path.basename(f).split('.')[0] for f in files]
+    names = names * max(1, args.lookups // len(names))
+
+    def lookup_all():
+        for name in names:
+            build_dependency_files.find_module(name, name_index, {})
+    _, seconds, peak = measure(lookup_all)
+    results['find_module'] = {'seconds': seconds, 'peak_bytes': peak,
+                              'index_seconds': index_seconds,
+                              'lookups_per_second': len(names) / seconds}
+
+    # End to end .d creation, each run in a new process like make does.
+    # Every run writes to a new outdir, so all .d files are created.
+    variants = {'cold': [],
+                'cached': ['--indexfile',
+                           os.path.join(workdir, 'e2e_index.json'),
+                           '--parsecache',
+                           os.path.join(workdir, 'parse_cache.json')]}
+    if args.jobs > 1:
+        variants['parallel'] = ['--jobs', str(args.jobs)]
+        variants['parallel_cached'] = (variants['cached']
+                                       + variants['parallel'])
+    for kind, extra in variants.items():
+        runs = [run_script(dep_args(os.path.join(workdir, f"{kind}_{run}"),
+                                    *extra),
+                           os.path.join(workdir, 'rusage.json'))
+                for run in range(args.repeat)]
+        depfiles = len(os.listdir(os.path.join(workdir, f"{kind}_0")))
+        seconds = min(r[0] for r in runs)
+        results[f"end_to_end_{kind}"] = {
+            'seconds': seconds,
+            'peak_rss_bytes': max(r[1] for r in runs),
+            'child_peak_rss_bytes': max(r[2] for r in runs),
+            'cpu_seconds': min(r[3] for r in runs),
+            'child_cpu_seconds': min(r[4] for r in runs),
+            'depfiles': depfiles,
+            'depfiles_per_second': depfiles / seconds}
+    return results
+
+
+def print_results(results):
+    design = results['design']
+    print(f"Design: {design['files']} files, {design['bytes'] / 1e6:.2f} MB")
+    for stage, values in results.items():
+        if stage == 'design':
+            continue
+        print(f"\n{stage}:")
+        for key, value in values.items():
+            if key.endswith('bytes'):
+                print(f"  {key:24s} {value / 1e6:10.2f} MB")
+            elif isinstance(value, float):
+                print(f"  {key:24s} {value:10.3f}")
+            else:
+                print(f"  {key:24s} {value:10d}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic design and time the dependency '
+        'scanner on it')
+    parser.add_argument('-m', '--modules', default=2000, type=int,
+                        help="number of modules, default 2000")
+    parser.add_argument('--depth', default=8, type=int,
+                        help="levels of hierarchy, default 8")
+    parser.add_argument('--fanout', default=4, type=int,
+                        help="instances in each module, default 4")
+    parser.add_argument('--packages', default=50, type=int,
+                        help="number of packages, default 50")
+    parser.add_argument('--includes', default=50, type=int,
+                        help="number of include files, default 50")
+    parser.add_argument('--ports', default=32, type=int,
+                        help="ports of each module, default 32")
+    parser.add_argument('--seed', default=1, type=int,
+                        help="random seed of the design, default 1")
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help="also time end to end with this many parse "
+                        "processes, default 1 (skip)")
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help="end to end runs, best is reported, default 3")
+    parser.add_argument('--lexer-kb', default=2500, type=int,
+                        help="size of each lexer case file, default 2500")
+    parser.add_argument('--lookups', default=100000, type=int,
+                        help="number of find_module lookups, default 100000")
+    parser.add_argument('--json', help="also write results to this file")
+    parser.add_argument('--keep', help="generate the design in this "
+                        "directory and keep it")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    workdir = tempfile.mkdtemp(prefix='bench_deps_')
+    srcdir = args.keep or os.path.join(workdir, 'src')
+    try:
+        top = generate_design(srcdir, args.modules, args.depth, args.fanout,
+                              args.packages, args.includes, args.ports,
+                              args.seed)
+        results = bench(args, srcdir, workdir, top)
+    finally:
+        shutil.rmtree(workdir)
+    print_results(results)
+    if args.json:
+        json.dump(results, open(args.json, 'w'), indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
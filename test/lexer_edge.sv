@@ -0,0 +1,11 @@
+// Lexer edge cases, run_test.sh checks the .d file of this module
+`define EDGE_W 2
+module lexer_edge (
+    input wire [pkg1::PKG1:0] clk,
+    input wire [`EDGE_W-1:0] data,
+    output logic [1:0] result
+  );
+  localparam string URL = "http://x/*"; submod2 u_after_string (clk, result[0]);
+  submod1#(.NAME("//"))u_no_space(.clk(data[`EDGE_W-1]), .done(result[1]));
+  assign result = pkg2::data_to_pipe(data[0]);
+endmodule: lexer_edge
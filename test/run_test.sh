@@ -1,7 +1,72 @@
 #!/bin/bash
 set -e
 
+# Lexer edge cases: comment markers in strings, packages in port lists,
+# macros in brackets and #( with no space
+../build/build_dependency_files.py . bld/lexer_deps questa lexer_edge > /dev/null
+if ! diff <(sed -n 1,5p bld/lexer_deps/lexer_edge.questa.d) - <<'END'
+$(DEP_DIR)/lexer_edge.questa.o: ./lexer_edge.sv\
+	$(DEP_DIR)/pkg1.questa.o\
+	$(DEP_DIR)/pkg2.questa.o\
+	$(DEP_DIR)/submod2.questa.o\
+	$(DEP_DIR)/submod1.questa.o
+END
+then
+    echo "The dependencies of lexer_edge don't match expected"
+    exit 1
+fi
+rm -rf bld/lexer_deps
+
+# Source index: files added, renamed and removed after the index is saved
+# are found by the next run. The source directory is relative and not a git
+# repo, so files are listed with find.
+index_test() {
+    (cd bld/index_test/src && "$build_scripts/build_dependency_files.py" \
+         --whole-design --indexfile ../index.json . ../deps questa top)
+}
+check_dep() {
+    if ! head -1 bld/index_test/deps/$1.questa.d | grep -q -- "$2"; then
+        echo "Source index: $1.questa.d doesn't match $2 after $3"
+        exit 1
+    fi
+}
+build_scripts=$(pwd)/../build
+mkdir -p bld/index_test/src/a/b
+echo "module top; amod u_a (); bmod u_b (); endmodule" > bld/index_test/src/top.sv
+echo "module amod; endmodule" > bld/index_test/src/a/amod.sv
+index_test > /dev/null
+check_dep amod ": ./a/amod.sv$" "indexing"
+check_dep top "o: ./top.sv\\\\$" "indexing"
+if index_test | grep -q "Indexing\|Reindexing"; then
+    echo "Source index: unchanged sources were indexed again"
+    exit 1
+fi
+mv bld/index_test/src/a/amod.sv bld/index_test/src/a/b/amod.sv
+index_test > /dev/null
+check_dep amod ": ./a/b/amod.sv$" "a rename"
+echo "module bmod; endmodule" > bld/index_test/src/a/bmod.sv
+index_test > /dev/null
+check_dep bmod ": ./a/bmod.sv$" "an add"
+rm bld/index_test/src/a/bmod.sv
+index_test > /dev/null
+if grep -q bmod bld/index_test/deps/top.questa.d; then
+    echo "Source index: removed file still in top.questa.d"
+    exit 1
+fi
+rm -rf bld/index_test
+
 SIM_TOOL=questa make -e comp
+# A comment edit checks the dependencies once, the .d file is kept and the
+# stamp stops the next run from checking again
+cp submod1.sv bld/submod1.sv.orig
+echo "// comment edit" >> submod1.sv
+SIM_TOOL=questa make -e comp > /dev/null
+if SIM_TOOL=questa make -e comp | grep -q "Identifying"; then
+    mv bld/submod1.sv.orig submod1.sv
+    echo "Dependencies were checked again for an unchanged source"
+    exit 1
+fi
+mv bld/submod1.sv.orig submod1.sv
 SIM_TOOL=modelsim make -e comp
 SIM_TOOL=vivado make -e comp
 SYNTH_OVERRIDE=y make project
@@ -21,5 +86,49 @@ fi
 if ! ls bld/deps/*quartus* > /dev/null; then
     echo "No quartus dependencies found"
 fi
+make clean
+# The whole design mode writes every .d file in one dependency run
+whole_design=$(WHOLE_DESIGN=1 SIM_TOOL=questa make -e comp)
+if [ $(echo "$whole_design" | grep -c "Identifying") -ne 1 ]; then
+    echo "The whole design took more than one dependency run"
+    exit 1
+fi
+if ! diff <(ls -1 bld/deps | grep "\.d$") - <<'END'
+mod1.questa.d
+my_incl.svh.questa.d
+pkg1.questa.d
+pkg2.questa.d
+submod1.questa.d
+submod2.questa.d
+END
+then
+    echo "The whole design .d files don't match expected"
+    exit 1
+fi
+make clean
+
+# Dependency loops: two headers that include each other are written once
+# and the include that closes the loop is dropped with a warning
+mkdir -p bld/loop_test/src
+printf '`include "loop_b.svh"\n' > bld/loop_test/src/loop_a.svh
+printf '`include "loop_a.svh"\n' > bld/loop_test/src/loop_b.svh
+printf 'module loop_top;\n`include "loop_a.svh"\nendmodule\n' \
+    > bld/loop_test/src/loop_top.sv
+(cd bld/loop_test/src && "$build_scripts/build_dependency_files.py" \
+     --whole-design . ../deps questa loop_top) > bld/loop_test/loop.log
+loop="loop_top -> loop_a.svh -> loop_b.svh -> loop_a.svh"
+if ! grep -q "Warning: dropping dependency loop $loop" bld/loop_test/loop.log
+then
+    echo "The header include loop wasn't dropped with a warning"
+    exit 1
+fi
+if grep -q "loop_a.svh.questa.o" bld/loop_test/deps/loop_b.svh.questa.d; then
+    echo "The header include loop is still in loop_b.svh.questa.d"
+    exit 1
+fi
+rm -rf bld/loop_test
+
+DEPS_TRACE=1 SIM_TOOL=questa make -e comp
+SIM_TOOL=questa make -e deps_trace
 make cleanall
 SIM_TOOL=vivado make -e cleanall
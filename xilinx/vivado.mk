@@ -73,19 +73,29 @@ ifdef SYNTH_SUBSTITUTIONS
 endif
 
 # The .d (dependent) targets are to calculate the dependencies of a file
-# The .d recipe is run whenever the sv file changes
-# The sv dependency is added in the .d file itself
+# The .deps.done stamp recipe is run whenever the sv file changes
+# The sv dependency of the stamp is added in the .d file itself
+# The .d file is only rewritten when the dependencies change, so make only
+#   restarts then, and the stamp keeps the check from running again
+# The .d recipe only runs the check when the .d file is missing
 # The '%' becomes the module name
 # The '$*' is replaced by that module name
-$(DEP_DIR)/%.vivado.d: $(SYNTH_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(BLOG_DIR)
-	@if [ -d $(SRC_BASE_DIR) ]; then\
-	  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
-	   "Identifying dependencies for $*$(UPDATE)" \
-	   "$(MAKEDEPEND_CMD) $(SUBS_VIVADO) $(MAKEDEP_TOOL_VIVADO) $*" \
-	   $(BLOG_DIR)/dependency_$*_vivado.log; \
-	else \
-	  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
-	fi
+define vivado-deps
+if [ -d $(SRC_BASE_DIR) ]; then\
+  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
+   "Identifying dependencies for $*$(UPDATE)" \
+   "$(MAKEDEPEND_CMD) $(SUBS_VIVADO) $(MAKEDEP_TOOL_VIVADO) $*" \
+   $(BLOG_DIR)/dependency_$*_vivado.log; \
+else \
+  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
+fi
+endef
+# make deletes the stamp as an intermediate file of the .d rule otherwise
+.PRECIOUS: $(DONE_DIR)/%.vivado.deps.done
+$(DONE_DIR)/%.vivado.deps.done: $(SYNTH_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(DONE_DIR) $(BLOG_DIR)
+	@$(vivado-deps)
+$(DEP_DIR)/%.vivado.d: $(DONE_DIR)/%.vivado.deps.done
+	@test -f $@ || { $(vivado-deps); }
 
 
 ##################### Include top level ##############################
@@ -138,7 +148,7 @@ $(TCL_DIR): | $(BLD_DIR)
 .PHONY: filelist_synth
 ## print list of files used in synth
 filelist_synth: $(DEP_DIR)/$(TOP_SYNTH).vivado.d
-	@grep "\.d:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
+	@grep "\.deps\.done:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
 .PHONY: modules_synth
 ## print list of modules used in synth
 modules_synth: $(DEP_DIR)/$(TOP_SYNTH).vivado.d
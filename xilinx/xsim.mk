@@ -71,19 +71,29 @@ ifdef SIM_SUBSTITUTIONS
 endif
 
 # The .d (dependent) targets are to calculate the dependencies of a file
-# The .d recipe is run whenever the sv file changes
-# The sv dependency is added in the .d file itself
+# The .deps.done stamp recipe is run whenever the sv file changes
+# The sv dependency of the stamp is added in the .d file itself
+# The .d file is only rewritten when the dependencies change, so make only
+#   restarts then, and the stamp keeps the check from running again
+# The .d recipe only runs the check when the .d file is missing
 # The '%' becomes the module name
 # The '$*' is replaced by that module name
-$(DEP_DIR)/%.xsim.d: $(XSIM_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(BLOG_DIR)
-	@if [ -d $(SRC_BASE_DIR) ]; then\
-	  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
-	   "$(CLEAR)Identifying dependencies for $*$(UPDATE)" \
-	   "$(MAKEDEPEND_CMD) $(SUBS_XSIM) $(MAKEDEP_TOOL_XSIM) $*" \
-	   $(BLOG_DIR)/dependency_$*_xsim.log; \
-	else \
-	  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
-	fi
+define xsim-deps
+if [ -d $(SRC_BASE_DIR) ]; then\
+  $(BUILD_SCRIPTS)/run_full_log_on_err.sh  \
+   "$(CLEAR)Identifying dependencies for $*$(UPDATE)" \
+   "$(MAKEDEPEND_CMD) $(SUBS_XSIM) $(MAKEDEP_TOOL_XSIM) $*" \
+   $(BLOG_DIR)/dependency_$*_xsim.log; \
+else \
+  echo -e "$(RED)Could not find SRC_BASE_DIR$(NC)"; false; \
+fi
+endef
+# make deletes the stamp as an intermediate file of the .d rule otherwise
+.PRECIOUS: $(DONE_DIR)/%.xsim.deps.done
+$(DONE_DIR)/%.xsim.deps.done: $(XSIM_SUB_DONE) $(predependency_hook) | $(DEP_DIR) $(DONE_DIR) $(BLOG_DIR)
+	@$(xsim-deps)
+$(DEP_DIR)/%.xsim.d: $(DONE_DIR)/%.xsim.deps.done
+	@test -f $@ || { $(xsim-deps); }
 
 
 ##################### Include top level ##############################
@@ -138,7 +148,7 @@ comp: $(DEP_DIR)/$(TOP_SIM).xsim.o $(prexcomp_hook)
 .PHONY: filelist_xsim
 ## target to print list of files used in xsim
 filelist_xsim: $(DEP_DIR)/$(TOP_SIM).xsim.d
-	@grep "\.d:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
+	@grep "\.deps\.done:" $(DEP_DIR)/* | cut -d " " -f 2 | sort | uniq
 .PHONY: modules_xsim
 ## target to print list of modules used in xsim
 modules_xsim: $(DEP_DIR)/$(TOP_SIM).xsim.d